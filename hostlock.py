@@ -0,0 +1,280 @@
+# Copyright 2013 Pieter Rautenbach
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import tempfile
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    from ConfigParser import SafeConfigParser as ConfigParser, Error as ConfigParserError
+except ImportError:
+    from configparser import ConfigParser, Error as ConfigParserError
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+"""Host-wide locks shared by all tagging processes running on the same machine.
+"""
+
+# Environment variable pointing to the throttling configuration file
+THROTTLE_CONFIG = 'TAGTRUNK_THROTTLE_CONFIG'
+# Environment variable overwriting the directory holding the lock files
+LOCK_DIR = 'TAGTRUNK_LOCK_DIR'
+# Seconds to wait between attempts to get a lock
+POLL_INTERVAL = 0.5
+# File name suffix of a queued lease ticket
+TICKET_SUFFIX = '.ticket'
+
+def get_lock_dir():
+    """Return (and create if required) the directory holding the lock files.
+    """
+    lockDir = os.getenv(LOCK_DIR)
+    if not lockDir:
+        lockDir = os.path.join(tempfile.gettempdir(), 'tagtrunk')
+    if not os.path.isdir(lockDir):
+        try:
+            os.makedirs(lockDir)
+        except OSError:
+            # Another process may have created it in the meantime
+            if not os.path.isdir(lockDir):
+                raise
+    return lockDir
+
+def get_server_key(url):
+    """Return a file name safe key identifying the server of a URL.
+    """
+    parsed = urlparse(url)
+    server = '{0}://{1}'.format(parsed.scheme, parsed.netloc)
+    return hashlib.md5(server.encode('utf-8')).hexdigest()
+
+def try_lock_file(f):
+    """Try to get an exclusive lock on an open file without blocking.
+
+    Returns True if the lock was obtained.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        return False
+    return True
+
+def lock_file(f):
+    """Get an exclusive lock on an open file, waiting as long as required.
+    """
+    while not try_lock_file(f):
+        time.sleep(POLL_INTERVAL)
+
+def unlock_file(f):
+    """Release the lock on an open file.
+    """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def get_throttle_settings(url):
+    """Get the import throttling settings for the server of a URL.
+
+    The configuration file (see THROTTLE_CONFIG) has a section per server URL,
+    with [DEFAULT] applying to all servers, e.g.
+
+    [DEFAULT]
+    max_concurrent_imports = 4
+    [https://svn.example.com]
+    max_concurrent_imports = 2
+    bytes_per_second = 10485760
+    burst_bytes = 52428800
+
+    A value of 0 (the default) means unlimited. Sections are matched on the
+    scheme and host of the URL only (any path in a section name is ignored),
+    just like the slots and buckets the settings apply to. Returns None if
+    throttling isn't configured, and raises ValueError if the configuration
+    is malformed (e.g. a value that isn't a number of bytes).
+    """
+    path = os.getenv(THROTTLE_CONFIG)
+    if not path or not os.path.isfile(path):
+        return None
+    config = ConfigParser()
+    try:
+        config.read(path)
+    except ConfigParserError as ex:
+        raise ValueError('{0}: {1}'.format(path, ex))
+    serverKey = get_server_key(url)
+    sections = [s for s in config.sections() if get_server_key(s) == serverKey]
+    if sections:
+        section = sections[0]
+        get = lambda option: config.getint(section, option) if config.has_option(section, option) else 0
+    else:
+        defaults = config.defaults()
+        get = lambda option: int(defaults.get(option, 0))
+    try:
+        settings = {'max_concurrent_imports': get('max_concurrent_imports'),
+                    'bytes_per_second': get('bytes_per_second'),
+                    'burst_bytes': get('burst_bytes')}
+    except ValueError as ex:
+        raise ValueError('{0}: {1}'.format(path, ex))
+    if settings['burst_bytes'] <= 0:
+        settings['burst_bytes'] = settings['bytes_per_second']
+    return settings
+
+def acquire_slot(url, max_concurrent):
+    """Wait for one of max_concurrent slots for the server of a URL.
+
+    Returns the open (locked) slot file, which must be passed to release_slot,
+    or None if the number of slots is unlimited. A slot held by a process that
+    dies is released by the operating system.
+    """
+    if max_concurrent <= 0:
+        return None
+    prefix = os.path.join(get_lock_dir(), 'import-{0}'.format(get_server_key(url)))
+    while True:
+        for i in range(max_concurrent):
+            f = open('{0}.slot{1}'.format(prefix, i), 'a+')
+            if try_lock_file(f):
+                return f
+            f.close()
+        time.sleep(POLL_INTERVAL)
+
+def release_slot(f):
+    """Release a slot obtained from acquire_slot.
+    """
+    if f is None:
+        return
+    unlock_file(f)
+    f.close()
+
+def consume_bandwidth(url, nbytes, bytes_per_second, burst_bytes, now=None):
+    """Take nbytes from the token bucket shared by all processes uploading to
+    the server of a URL.
+
+    The bucket refills at bytes_per_second up to burst_bytes. Taking more than
+    is available puts the bucket into debt, and the caller has to wait until
+    the debt is paid off before it starts its upload. This paces the starts of
+    concurrent uploads so that their combined rate stays at bytes_per_second.
+
+    Returns the number of seconds the caller must wait.
+    """
+    if bytes_per_second <= 0:
+        return 0.0
+    if now is None:
+        now = time.time()
+    path = os.path.join(get_lock_dir(), 'bucket-{0}'.format(get_server_key(url)))
+    f = open(path, 'a+')
+    try:
+        lock_file(f)
+        f.seek(0)
+        state = f.read().split()
+        if len(state) == 2:
+            tokens = min(burst_bytes, float(state[0]) + (now - float(state[1])) * bytes_per_second)
+        else:
+            tokens = float(burst_bytes)
+        tokens -= nbytes
+        f.seek(0)
+        f.truncate()
+        f.write('{0} {1}'.format(tokens, now))
+        f.flush()
+        unlock_file(f)
+    finally:
+        f.close()
+    if tokens >= 0:
+        return 0.0
+    return -tokens / bytes_per_second
+
+def acquire_lease(key):
+    """Get the exclusive lease on a key (e.g. a tag URL), waiting for earlier
+    holders to finish.
+
+    Every waiter queues a ticket. Once the lease is free, a waiter that finds
+    a newer live ticket in the queue gives up, so that only the newest of the
+    waiting processes goes ahead. Tickets of processes that died are removed.
+    The lease file records the newest ticket that ever held the lease, so a
+    waiter also gives up if a newer process already got (and released) the
+    lease before it.
+
+    Returns the lease, which must be passed to release_lease, or None if this
+    process has been superseded.
+    """
+    leaseDir = os.path.join(get_lock_dir(), 'lease-{0}'.format(hashlib.md5(key.encode('utf-8')).hexdigest()))
+    if not os.path.isdir(leaseDir):
+        try:
+            os.makedirs(leaseDir)
+        except OSError:
+            if not os.path.isdir(leaseDir):
+                raise
+    # Tickets sort by the time they were queued
+    ticketName = '{0:020.6f}-{1}{2}'.format(time.time(), os.getpid(), TICKET_SUFFIX)
+    ticketPath = os.path.join(leaseDir, ticketName)
+    ticket = open(ticketPath, 'a+')
+    lock_file(ticket)
+    lock = open(os.path.join(leaseDir, 'lease'), 'a+')
+    lock_file(lock)
+    lock.seek(0)
+    newest = lock.read().strip()
+    if newest > ticketName or __has_newer_ticket(leaseDir, ticketName):
+        unlock_file(lock)
+        lock.close()
+        __close_ticket(ticket, ticketPath)
+        return None
+    lock.seek(0)
+    lock.truncate()
+    lock.write(ticketName)
+    lock.flush()
+    return (lock, ticket, ticketPath)
+
+def release_lease(lease):
+    """Release a lease obtained from acquire_lease.
+    """
+    if lease is None:
+        return
+    (lock, ticket, ticketPath) = lease
+    __close_ticket(ticket, ticketPath)
+    unlock_file(lock)
+    lock.close()
+
+def __has_newer_ticket(leaseDir, ticketName):
+    """Check whether a live process queued a ticket after the given one.
+    Tickets that can be locked belong to processes that died and are removed.
+    """
+    for name in sorted(os.listdir(leaseDir), reverse=True):
+        if not name.endswith(TICKET_SUFFIX) or name <= ticketName:
+            continue
+        path = os.path.join(leaseDir, name)
+        f = open(path, 'a+')
+        if try_lock_file(f):
+            __close_ticket(f, path)
+        else:
+            f.close()
+            return True
+    return False
+
+def __close_ticket(ticket, ticketPath):
+    """Unlock, close and remove a ticket.
+    """
+    unlock_file(ticket)
+    ticket.close()
+    try:
+        os.remove(ticketPath)
+    except OSError:
+        pass
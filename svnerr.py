@@ -18,4 +18,7 @@
 # for an explanation of use and codes.
 FS_NOT_FOUND = 160013
 FS_ALREADY_EXISTS = 160020
+FS_CONFLICT = 160024
+FS_TXN_OUT_OF_DATE = 160028
+RA_ILLEGAL_URL = 170000
 RA_DAV_REQUEST_FAILED = 175002
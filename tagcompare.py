@@ -0,0 +1,82 @@
+#!/usr/local/bin/python2.7
+# Copyright 2013 Pieter Rautenbach
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import os
+    import traceback
+    import tagutils
+except Exception as ex:
+    print('One or more classes or modules could not be imported: {0}'.format(ex))
+    exit(1)
+
+def main():
+    """ Standalone Python script used to compare two tags of a project.
+
+    Exit codes:
+    0 - normal termination
+    1 - other errors
+    2 - syntax error
+    """
+
+    # Subversion server account credentials
+    # TODO: Implement a ConfigParser
+    __SVN_USERNAME = 'teamcity'
+    __SVN_PASSWORD = 'Password123'
+
+    try:
+        # Get command-line parameters
+        parser = tagutils.setup_compare_argument_parser()
+        args = parser.parse_args()
+
+        # Check command-line arguments
+        (valid, errorMessage) = tagutils.validate_compare_args(args)
+        if not valid:
+            tagutils.print_teamcity_error_message(errorMessage)
+            exit(1)
+
+        # Store all parameters in a dictionary
+        param_dict = {}
+
+        # Get repository information
+        client = tagutils.setup_svn_client(__SVN_USERNAME, __SVN_PASSWORD)
+        info = tagutils.get_repository_info(client, os.getcwd())
+        if info is None:
+            tagutils.print_teamcity_error_message('Could not get repository info')
+            exit(1)
+
+        # Construct and assign all required parameters
+        tagutils.assign_compare_params(info, args, param_dict)
+        for url in [param_dict['From Tag URL'], param_dict['To Tag URL']]:
+            if not tagutils.path_exists(client, url):
+                tagutils.print_teamcity_error_message('Tag {0} doesn\'t exist'.format(url))
+                exit(1)
+
+        report = tagutils.compare_tags(client,
+                                       param_dict['From Tag URL'],
+                                       param_dict['To Tag URL'],
+                                       param_dict['Source'],
+                                       param_dict['Build'])
+        tagutils.print_comparison(report)
+        if args.output is not None:
+            tagutils.write_json(report, args.output)
+        exit(0)
+
+    except Exception as ex:
+        print('An unexpected error occurred')
+        traceback.print_exc()
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/local/bin/python2.7
+# Copyright 2013 Pieter Rautenbach
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import time
+import traceback
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+"""Historical metrics of tagging runs, stored in a local SQLite database, and
+the command used to report on them.
+"""
+
+# Overwriting environment variable for the metrics database
+METRICS_DB = 'TAGTRUNK_METRICS_DB'
+# Percentiles reported per project and server
+PERCENTILES = [50, 95, 99]
+# Client operations that commit when given URLs
+COMMITTING_OPERATIONS = ['remove', 'mkdir', 'copy', 'copy2', 'move2', 'import_', 'checkin']
+# Operations that only commit when given URLs; on working copy paths they are
+# scheduled for the next checkin
+URL_OPERATIONS = ['remove', 'mkdir']
+
+class CommitCounter(object):
+    """Proxy of a pysvn client that counts the operations that commit.
+    """
+
+    def __init__(self, client):
+        self.__dict__['client'] = client
+        self.__dict__['commits'] = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in COMMITTING_OPERATIONS:
+            return attr
+        def counted(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if name in URL_OPERATIONS and not self.__is_url_argument(args[0] if args else ''):
+                return result
+            # A checkin with nothing to commit returns None
+            if not (name == 'checkin' and result is None):
+                self.__dict__['commits'] += 1
+            return result
+        return counted
+
+    def __setattr__(self, name, value):
+        setattr(self.client, name, value)
+
+    def __is_url_argument(self, paths):
+        """Return True if a path or list of paths passed to pysvn are URLs.
+        """
+        if isinstance(paths, (list, tuple)):
+            return any([self.__is_url_argument(path) for path in paths])
+        return '://' in paths
+
+def get_db_path():
+    """Return the path of the metrics database, creating its directory if
+    required.
+    """
+    path = os.getenv(METRICS_DB)
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.tagtrunk', 'metrics.sqlite')
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return path
+
+def start_run():
+    """Start measuring a tagging run. The first phase starts now.
+    """
+    now = time.time()
+    return {'started': now,
+            'phase_started': now,
+            'phases': [],
+            'project': None,
+            'server': None,
+            'tag_type': None,
+            'bytes': None,
+            'client': None}
+
+def set_project(run, project, url, tag_type):
+    """Set the project, server (from any URL in the repository) and tag type
+    of a run. Runs without a project aren't recorded.
+    """
+    parsed = urlparse(url)
+    run['project'] = project
+    run['server'] = '{0}://{1}'.format(parsed.scheme, parsed.netloc)
+    run['tag_type'] = tag_type
+
+def count_commits(run, client):
+    """Wrap a client so that the commits of the run are counted.
+    """
+    run['client'] = CommitCounter(client)
+    return run['client']
+
+def end_phase(run, phase):
+    """End a phase of a run; the next phase starts now.
+    """
+    now = time.time()
+    run['phases'].append((phase, now - run['phase_started']))
+    run['phase_started'] = now
+
+def __connect(db_path):
+    """Open the metrics database, creating the tables if required.
+    """
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute('CREATE TABLE IF NOT EXISTS runs ('
+                       'id INTEGER PRIMARY KEY, started REAL, project TEXT, server TEXT, tag_type TEXT, '
+                       'exit_code INTEGER, duration REAL, bytes INTEGER, commits INTEGER)')
+    connection.execute('CREATE TABLE IF NOT EXISTS phases (run_id INTEGER, phase TEXT, duration REAL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS runs_project ON runs (project, server)')
+    return connection
+
+def record_run(run, exit_code, db_path=None):
+    """Append a finished run and its phases to the metrics database.
+
+    Metrics must never fail a tagging run, so errors are returned as a
+    message instead of raised. Returns None if the run was recorded (or
+    has no project).
+    """
+    if run is None or run['project'] is None:
+        return None
+    commits = 0
+    if run['client'] is not None:
+        commits = run['client'].commits
+    try:
+        connection = __connect(db_path or get_db_path())
+        try:
+            cursor = connection.execute('INSERT INTO runs (started, project, server, tag_type, exit_code, duration, bytes, commits) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        (run['started'], run['project'], run['server'], run['tag_type'],
+                                         exit_code, time.time() - run['started'], run['bytes'], commits))
+            connection.executemany('INSERT INTO phases (run_id, phase, duration) VALUES (?, ?, ?)',
+                                   [(cursor.lastrowid, phase, duration) for (phase, duration) in run['phases']])
+            connection.commit()
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError, IOError) as ex:
+        return 'Could not record metrics: {0}'.format(ex)
+    return None
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest-rank method).
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+def get_report(db_path=None, since=None):
+    """Summarise the recorded runs per project and per server.
+
+    Returns a list of dictionaries with the group ('project' or 'server'),
+    its name, the number of runs and failures, the total bytes (of the runs
+    that know them) and commits, the total duration and the duration
+    percentiles of the runs and of each phase.
+    """
+    connection = __connect(db_path or get_db_path())
+    try:
+        query = 'SELECT id, project, server, exit_code, duration, bytes, commits FROM runs'
+        params = ()
+        if since is not None:
+            query += ' WHERE started >= ?'
+            params = (since,)
+        runs = connection.execute(query, params).fetchall()
+        phases = {}
+        for (run_id, phase, duration) in connection.execute('SELECT run_id, phase, duration FROM phases'):
+            phases.setdefault(run_id, []).append((phase, duration))
+    finally:
+        connection.close()
+    groups = {}
+    for run in runs:
+        for (group, name) in [('project', run[1]), ('server', run[2])]:
+            groups.setdefault((group, name), []).append(run)
+    report = []
+    for ((group, name), group_runs) in sorted(groups.items()):
+        phase_durations = {}
+        for run in group_runs:
+            for (phase, duration) in phases.get(run[0], []):
+                phase_durations.setdefault(phase, []).append(duration)
+        report.append({'group': group,
+                       'name': name,
+                       'runs': len(group_runs),
+                       'failures': len([run for run in group_runs if not run[3] == 0]),
+                       'bytes': sum([run[5] or 0 for run in group_runs]),
+                       'commits': sum([run[6] for run in group_runs]),
+                       'total_duration': sum([run[4] for run in group_runs]),
+                       'duration': dict([(p, percentile([run[4] for run in group_runs], p)) for p in PERCENTILES]),
+                       'phases': dict([(phase, dict([(p, percentile(durations, p)) for p in PERCENTILES]))
+                                       for (phase, durations) in phase_durations.items()])})
+    return report
+
+def print_report(report):
+    """Print a metrics report to stdout.
+    """
+    header = ''.join(['{0:>10}'.format('p{0}'.format(p)) for p in PERCENTILES])
+    for entry in report:
+        print('{0} {1}: {2} runs, {3} failed, {4} bytes, {5} commits'.format(entry['group'].capitalize(),
+                                                                             entry['name'],
+                                                                             entry['runs'],
+                                                                             entry['failures'],
+                                                                             entry['bytes'],
+                                                                             entry['commits']))
+        print('\t{0:<12}{1}'.format('', header))
+        rows = [('total', entry['duration'])] + sorted(entry['phases'].items())
+        for (phase, durations) in rows:
+            print('\t{0:<12}{1}'.format(phase, ''.join(['{0:>9.2f}s'.format(durations[p]) for p in PERCENTILES])))
+
+def __format_label(entry):
+    """Format the label of a report entry, e.g. project="foo".
+    """
+    name = entry['name'].replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{0}="{1}"'.format(entry['group'], name)
+
+def export_textfile(path, db_path=None):
+    """Write the metrics report as a text file for the node exporter's
+    textfile collector. The collector parses the Prometheus text format, so
+    OpenMetrics-only syntax (such as # EOF) isn't used, and counters are
+    declared with their _total names. The file is replaced atomically.
+
+    Every metric family has a single label, so there is one family per
+    project and one per server, e.g. tagtrunk_project_runs_total{project="foo"}
+    and tagtrunk_server_runs_total{server="http://svn"}.
+    """
+    report = get_report(db_path)
+    lines = []
+    for group in ['project', 'server']:
+        entries = [entry for entry in report if entry['group'] == group]
+        metric = 'tagtrunk_{0}_run_duration_seconds'.format(group)
+        lines.append('# HELP {0} Duration of tagging runs per {1}.'.format(metric, group))
+        lines.append('# TYPE {0} summary'.format(metric))
+        for entry in entries:
+            for p in PERCENTILES:
+                lines.append('{0}{{{1},quantile="{2}"}} {3}'.format(metric, __format_label(entry), p / 100.0, entry['duration'][p]))
+            lines.append('{0}_sum{{{1}}} {2}'.format(metric, __format_label(entry), entry['total_duration']))
+            lines.append('{0}_count{{{1}}} {2}'.format(metric, __format_label(entry), entry['runs']))
+        for (name, key, description) in [('runs', 'runs', 'Tagging runs'),
+                                         ('failed_runs', 'failures', 'Failed tagging runs'),
+                                         ('uploaded_bytes', 'bytes', 'Bytes of build artifacts uploaded'),
+                                         ('commits', 'commits', 'Commits made by tagging runs')]:
+            metric = 'tagtrunk_{0}_{1}_total'.format(group, name)
+            lines.append('# HELP {0} {1} per {2}.'.format(metric, description, group))
+            lines.append('# TYPE {0} counter'.format(metric))
+            for entry in entries:
+                lines.append('{0}{{{1}}} {2}'.format(metric, __format_label(entry), entry[key]))
+    temp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(temp, path)
+
+def setup_argument_parser():
+    """Setup the command-line argument parser's parameters, help, etc.
+    """
+    parser = argparse.ArgumentParser(description='Report on the metrics of past tagging runs.')
+    parser.add_argument('--db',
+                        help='the metrics database; the default is ${0} or ~/.tagtrunk/metrics.sqlite'.format(METRICS_DB))
+    subparsers = parser.add_subparsers(dest='command')
+    report = subparsers.add_parser('report',
+                                   help='print run and phase duration percentiles per project and per server')
+    report.add_argument('--days',
+                        type=float,
+                        help='only include runs of the last DAYS days')
+    export = subparsers.add_parser('export',
+                                   help='write the metrics for the node exporter\'s textfile collector')
+    export.add_argument('FILE',
+                        help='the file to write, e.g. in the node exporter\'s textfile directory')
+    return parser
+
+def main():
+    """ Standalone Python script used to report on the metrics of tagging runs.
+
+    Exit codes:
+    0 - normal termination
+    1 - other errors
+    2 - syntax error
+    """
+    try:
+        parser = setup_argument_parser()
+        args = parser.parse_args()
+        if args.command == 'report':
+            since = None
+            if args.days is not None:
+                since = time.time() - args.days * 24 * 60 * 60
+            print_report(get_report(args.db, since))
+        elif args.command == 'export':
+            export_textfile(args.FILE, args.db)
+        else:
+            parser.print_usage()
+            exit(2)
+        exit(0)
+    except Exception as ex:
+        print('An unexpected error occurred')
+        traceback.print_exc()
+        exit(1)
+
+if __name__ == "__main__":
+    main()
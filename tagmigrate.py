@@ -0,0 +1,71 @@
+#!/usr/local/bin/python2.7
+# Copyright 2013 Pieter Rautenbach
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import os
+    import traceback
+    import tagutils
+except Exception as ex:
+    print('One or more classes or modules could not be imported: {0}'.format(ex))
+    exit(1)
+
+def main():
+    """ Standalone Python script used to move the tags of a project into the
+    sharded layout tags/<major>/<major>.<minor>/ and index them.
+
+    Exit codes:
+    0 - normal termination
+    1 - other errors
+    2 - syntax error
+    """
+
+    # Subversion server account credentials
+    # TODO: Implement a ConfigParser
+    __SVN_USERNAME = 'teamcity'
+    __SVN_PASSWORD = 'Password123'
+
+    try:
+        # Get command-line parameters
+        parser = tagutils.setup_migrate_argument_parser()
+        args = parser.parse_args()
+
+        # Get repository information
+        client = tagutils.setup_svn_client(__SVN_USERNAME, __SVN_PASSWORD)
+        info = tagutils.get_repository_info(client, os.getcwd())
+        if info is None:
+            tagutils.print_teamcity_error_message('Could not get repository info')
+            exit(1)
+
+        # Construct and assign all required parameters
+        param_dict = {}
+        tagutils.assign_project_params(info, param_dict)
+
+        migration = tagutils.plan_migration(client, param_dict['Root URL'], param_dict['Name'])
+        unindexed = tagutils.find_unindexed_tags(client, param_dict['Root URL'], param_dict['Name'])
+        tagutils.print_migration(migration, unindexed)
+        if not migration and not unindexed:
+            tagutils.print_teamcity_info_message('No tags to migrate')
+        elif not args.dry_run:
+            tagutils.migrate_tags(client, param_dict['Root URL'], migration, unindexed)
+            tagutils.print_teamcity_info_message('Migrated {0} tags'.format(len(migration)))
+        exit(0)
+
+    except Exception as ex:
+        print('An unexpected error occurred')
+        traceback.print_exc()
+        exit(1)
+
+if __name__ == "__main__":
+    main()
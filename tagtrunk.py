@@ -16,6 +16,8 @@
 try:
     import os
     import traceback
+    import hostlock
+    import tagmetrics
     import tagutils
 except Exception as ex:
     print('One or more classes or modules could not be imported: {0}'.format(ex))
@@ -35,6 +37,9 @@ def main():
     __SVN_USERNAME = 'teamcity'
     __SVN_PASSWORD = 'Password123'
 
+    # Phase durations, bytes uploaded, commits and outcome of this run
+    run = tagmetrics.start_run()
+
     try:
         # Get command-line parameters
         parser = tagutils.setup_argument_parser()
@@ -50,7 +55,7 @@ def main():
         param_dict = {}
 
         # Get repository information
-        client = tagutils.setup_svn_client(__SVN_USERNAME, __SVN_PASSWORD)
+        client = tagmetrics.count_commits(run, tagutils.setup_svn_client(__SVN_USERNAME, __SVN_PASSWORD))
         info = tagutils.get_repository_info(client, os.getcwd())
         if info is None:
             tagutils.print_teamcity_error_message('Could not get repository info')
@@ -59,32 +64,137 @@ def main():
         # Construct and assign all required parameters
         tagutils.assign_params(info, args, param_dict)
         tagutils.print_script_parameters(param_dict)
+        marker = None if args.watch is None else os.path.join(param_dict['Trunk'], args.watch)
 
-        # Dev tag excludes build digit so that it can be deleted easily
-        if tagutils.is_dev_tag(param_dict['Tag Type']):
-            tagutils.remove_dev_tag(client, param_dict['Tag URL'])
-        if not tagutils.create_tag(client,
-                                   param_dict['Name'],
-                                   param_dict['Version'],
-                                   param_dict['Trunk URL'],
-                                   param_dict['Tag URL'],
-                                   param_dict['Tag Source URL']):
-            tagutils.print_teamcity_error_message('Could not create tag')
-            exit(1)
-        if not tagutils.import_artifacts(client,
-                                         param_dict['Name'],
-                                         param_dict['Version'],
-                                         param_dict['Build Source Full'],
-                                         param_dict['Tag Build URL']):
-            tagutils.print_teamcity_error_message('Could not import build artifacts')
+        # Only report what would be done
+        if args.plan is not None:
+            run = None
+            plan = tagutils.plan_tagging(client, param_dict, args.changelog, marker)
+            tagutils.write_json(plan, args.plan)
+            exit(0)
+
+        tagmetrics.set_project(run, param_dict['Name'], param_dict['Trunk URL'], param_dict['Tag Type'])
+        tagmetrics.end_phase(run, 'setup')
+
+        # Fail fast before anything gets written to the repository
+        (valid, errorMessage) = tagutils.preflight_checks(client, param_dict, marker is None, marker)
+        tagmetrics.end_phase(run, 'preflight')
+        if not valid:
+            tagutils.print_teamcity_error_message(errorMessage)
             exit(1)
+
+        # Only one build at a time may replace a dev tag, and a newer build
+        # waiting for the same tag supersedes this one
+        lease = None
+        if tagutils.is_dev_tag(param_dict['Tag Type']):
+            lease = tagutils.acquire_dev_tag_lease(param_dict['Tag URL'])
+            if lease is None:
+                tagutils.print_teamcity_info_message('Tagging superseded by a newer build')
+                exit(0)
+            tagmetrics.end_phase(run, 'lease')
+        try:
+            # Dev tag excludes build digit so that it can be deleted easily
+            if tagutils.is_dev_tag(param_dict['Tag Type']):
+                tagutils.remove_dev_tag(client, param_dict['Tag URL'])
+            if tagutils.is_sharded_layout():
+                tagutils.create_shard(client, param_dict['Tag URL'])
+            if not tagutils.create_tag(client,
+                                       param_dict['Name'],
+                                       param_dict['Version'],
+                                       param_dict['Trunk URL'],
+                                       param_dict['Tag URL'],
+                                       param_dict['Tag Source URL'],
+                                       param_dict['Selection']):
+                tagutils.print_teamcity_error_message('Could not create tag')
+                exit(1)
+            tagmetrics.end_phase(run, 'create')
+            # Read and validated by the preflight checks
+            throttle = param_dict['Throttle']
+            try:
+                if len(param_dict['Artifacts']) > 1:
+                    # All build sources go into the tag in a single commit
+                    imported = tagutils.import_artifact_roots(client,
+                                                              param_dict['Name'],
+                                                              param_dict['Version'],
+                                                              param_dict['Artifacts'],
+                                                              param_dict['Tag URL'],
+                                                              # Next to trunk, as trunk may itself be a build source
+                                                              os.path.dirname(os.path.abspath(param_dict['Trunk'])),
+                                                              throttle)
+                elif args.watch is None:
+                    imported = tagutils.import_artifacts(client,
+                                                         param_dict['Name'],
+                                                         param_dict['Version'],
+                                                         param_dict['Build Source Full'],
+                                                         param_dict['Tag Build URL'],
+                                                         throttle,
+                                                         param_dict['Artifact Bytes'])
+                else:
+                    # Upload artifacts while the build is still running
+                    imported = tagutils.watch_artifacts(client,
+                                                        param_dict['Name'],
+                                                        param_dict['Version'],
+                                                        param_dict['Build Source Full'],
+                                                        param_dict['Tag Build URL'],
+                                                        marker,
+                                                        throttle)
+            except Exception:
+                # Don't leave a tag with the source code but without (all) artifacts
+                tagutils.remove_incomplete_tag(client, param_dict['Tag URL'])
+                raise
+            tagmetrics.end_phase(run, 'import')
+            if not imported:
+                tagutils.remove_incomplete_tag(client, param_dict['Tag URL'])
+                tagutils.print_teamcity_error_message('Could not import build artifacts')
+                exit(1)
+            if args.watch is None:
+                # Scanned by the preflight checks; unknown up front when watching
+                run['bytes'] = param_dict['Artifact Bytes']
+            if args.verify:
+                mismatches = tagutils.verify_artifacts(client, param_dict['Artifacts'], param_dict['Tag URL'], marker)
+                tagmetrics.end_phase(run, 'verify')
+                for mismatch in mismatches:
+                    tagutils.print_teamcity_verification_message(mismatch)
+                if mismatches:
+                    tagutils.print_teamcity_error_message('Tag doesn\'t match build artifacts ({0} mismatches)'.format(len(mismatches)))
+                    exit(1)
+            if args.changelog:
+                changelog = tagutils.create_changelog(client,
+                                                      param_dict['Name'],
+                                                      param_dict['Version'],
+                                                      param_dict['Tag Type'],
+                                                      param_dict['Root URL'],
+                                                      param_dict['Trunk URL'],
+                                                      param_dict['Tag URL'])
+                tagutils.attach_changelog(client,
+                                          param_dict['Name'],
+                                          param_dict['Version'],
+                                          param_dict['Tag URL'],
+                                          changelog)
+                tagmetrics.end_phase(run, 'changelog')
+            if tagutils.is_sharded_layout():
+                tagutils.index_tag(client, param_dict['Root URL'], param_dict['Tag URL'])
+                tagmetrics.end_phase(run, 'index')
+        finally:
+            hostlock.release_lease(lease)
         tagutils.print_teamcity_info_message('Tagging process succeeded')
         exit(0)
 
+    except SystemExit as se:
+        __record_run(run, se.code)
+        raise
     except Exception as ex:
         print('An unexpected error occurred')
         traceback.print_exc()
+        __record_run(run, 1)
         exit(1)
 
+def __record_run(run, exit_code):
+    """Record the metrics of a run, without letting metrics fail the run.
+    """
+    errorMessage = tagmetrics.record_run(run, exit_code)
+    if errorMessage is not None:
+        tagutils.print_teamcity_info_message(errorMessage)
+
 if __name__ == "__main__":
     main()
@@ -13,8 +13,15 @@
 # limitations under the License.
 
 import argparse
+import hashlib
+import json
 import os.path
+import shutil
 import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+import hostlock
 import svnerr
 import pysvn
 
@@ -29,8 +36,32 @@ DEFAULT_TAG_TYPE = 'final'
 SUPPRESS_STD_OUT = False
 # Subversion path separator
 SVN_SEP = '/'
+# Subversion working copy administrative directory, which is never imported
+SVN_ADMIN_DIR = '.svn'
 # Version number separator
 VER_SEP = '.'
+# Overwriting environment variable for the local cache directory
+CACHE_DIR = 'TAGTRUNK_CACHE_DIR'
+# Tag name separator
+TAG_SEP = '-'
+# Environment variable selecting the layout of the tags directory
+TAG_LAYOUT = 'TAGTRUNK_TAG_LAYOUT'
+# Layout with tags in tags/<major>/<major>.<minor>/ instead of directly in tags/
+SHARDED_LAYOUT = 'sharded'
+# Name of the index file listing all tags in a sharded tags directory
+TAG_INDEX_NAME = 'INDEX.txt'
+# Number of attempts to commit the tag index when other builds update it too
+TAG_INDEX_ATTEMPTS = 5
+# Name of the changelog file added to a tag
+CHANGELOG_NAME = 'CHANGELOG.txt'
+# Number of threads used to scan an artifact tree
+SCAN_WORKERS = 8
+# JSON output path that denotes stdout
+JSON_STDOUT = '-'
+# Seconds between polls of the build source in watch mode
+WATCH_INTERVAL = 5
+# Seconds after which watch mode gives up waiting for the build to complete
+WATCH_TIMEOUT = 6 * 60 * 60
 
 def setup_argument_parser():
     """Setup the command-line argument parser's parameters, help, etc.
@@ -42,7 +73,7 @@ def setup_argument_parser():
     parser.add_argument('V',
                         help='the version of the application in the format <major>.<minor>.<revision>.<build>')
     parser.add_argument('S',
-                        help='the target directory in the repository where the source code must go')
+                        help='the target directory in the repository where the source code must go, optionally followed by a colon and a comma-separated list of trunk subpaths to copy instead of the whole trunk, e.g. src:lib,include')
     parser.add_argument('B',
                         nargs='?',
                         default='build',
@@ -55,8 +86,71 @@ def setup_argument_parser():
                         nargs='?',
                         default=DEFAULT_TAG_TYPE,
                         help='type of tag (dev, rc<no> or final); the default is final')
+    parser.add_argument('--plan',
+                        metavar='FILE',
+                        help='don\'t tag, but write a JSON plan of all operations and their cost to FILE (- for stdout)')
+    parser.add_argument('--artifacts',
+                        metavar='SOURCE=TARGET',
+                        action='append',
+                        help='an additional source directory on disk which will be added to the repository in the TARGET directory of the tag, in the same commit as BS; can be repeated')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='after importing, check that the artifacts in the tag match the build sources on disk')
+    parser.add_argument('--changelog',
+                        action='store_true',
+                        help='add the trunk log since the previous tag of the same type to the tag as {0}'.format(CHANGELOG_NAME))
+    parser.add_argument('--watch',
+                        metavar='MARKER',
+                        help='start before the build and upload artifacts while they are being built; the build signals completion by creating the file MARKER')
     return parser
 
+def setup_compare_argument_parser():
+    """Setup the command-line argument parser's parameters, help, etc. for
+    comparing two tags.
+    """
+    __print_if_not_suppressed('Setting up argument parser')
+    prog = os.path.basename(sys.argv[0])
+    parser = argparse.ArgumentParser(description='Compare two tags of a project in a Subversion repository.',
+                                     epilog='Example: {0} 1.2.0.0-final 1.2.1.0-final src build'.format(prog))
+    parser.add_argument('FROM',
+                        help='the older tag in the format <version>-<type>')
+    parser.add_argument('TO',
+                        help='the newer tag in the format <version>-<type>')
+    parser.add_argument('S',
+                        help='the directory in the tags where the source code is')
+    parser.add_argument('B',
+                        nargs='?',
+                        default='build',
+                        help='the build directory in the tags')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        help='also write the comparison as JSON to FILE (- for stdout)')
+    return parser
+
+def setup_migrate_argument_parser():
+    """Setup the command-line argument parser's parameters, help, etc. for
+    migrating tags to the sharded layout.
+    """
+    __print_if_not_suppressed('Setting up argument parser')
+    parser = argparse.ArgumentParser(description='Move the tags of a project in a Subversion repository into the sharded layout tags/<major>/<major>.<minor>/.')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only show which tags would be moved where')
+    return parser
+
+def validate_compare_args(args):
+    """Check whether the tags to compare are valid.
+
+    Returns a tuple (valid, errorMessage), where valid=True/False
+    and errorMessage will be populated if invalid (or valid=False)
+    """
+    __print_if_not_suppressed('Validating command-line arguments')
+    for spec in [args.FROM, args.TO]:
+        (version, _, tag_type) = spec.rpartition(TAG_SEP)
+        if tag_type == '' or not (is_version_number(version) or (is_dev_tag(tag_type) and is_version_number('{0}.0'.format(version)))):
+            return (False, 'Invalid tag {0}'.format(spec))
+    return (True, '')
+
 def validate_args(args):
     """Check whether specific parameters are valid.
 
@@ -66,10 +160,33 @@ def validate_args(args):
     __print_if_not_suppressed('Validating command-line arguments')
     if not is_version_number(args.V):
         return (False, 'Invalid version number {0}'.format(args.V))
+    (_, _, selection) = args.S.partition(':')
+    if selection:
+        subpaths = [normalise_relative_path(subpath) for subpath in selection.split(',')]
+        if SVN_SEP in subpaths:
+            return (False, 'Invalid source selection {0}'.format(selection))
+        for subpath in subpaths:
+            if [other for other in subpaths if other == subpath or other.startswith(subpath + SVN_SEP)] != [subpath]:
+                return (False, 'Source selection {0} contains duplicate or nested subpaths'.format(selection))
+    if args.artifacts:
+        if args.watch is not None:
+            return (False, 'Additional artifacts can\'t be watched')
+        targets = [normalise_relative_path(args.B)]
+        for mapping in args.artifacts:
+            (source, _, target) = mapping.rpartition('=')
+            if source == '' or target == '':
+                return (False, 'Invalid artifacts mapping {0}'.format(mapping))
+            targets.append(normalise_relative_path(target))
+        if not len(set(targets)) == len(targets):
+            return (False, 'Artifact targets must be unique')
     return (True, '')
 
 def setup_svn_client(username, password):
     """Create and configure an instance of a SVN client.
+
+    Each run creates one client and uses it for all its operations. Turning
+    off the auth cache only keeps credentials off disk; the client still
+    reuses them in memory for its lifetime.
     """
     __print_if_not_suppressed('Setting up Subversion client')
     client = pysvn.Client()
@@ -139,9 +256,13 @@ def print_script_parameters(param_dict):
     # Disk paths
     __print_if_not_suppressed('\tTrunk:             {0}'.format(param_dict['Trunk']))
     __print_if_not_suppressed('\tSource:            {0}'.format(param_dict['Source']))
+    if param_dict['Selection']:
+        __print_if_not_suppressed('\tSelection:         {0}'.format(', '.join(param_dict['Selection'])))
     __print_if_not_suppressed('\tBuild:             {0}'.format(param_dict['Build']))
     __print_if_not_suppressed('\tBuild Source:      {0}'.format(param_dict['Build Source']))
     __print_if_not_suppressed('\tBuild Source Full: {0}'.format(param_dict['Build Source Full']))
+    for (source, target) in param_dict['Artifacts'][1:]:
+        __print_if_not_suppressed('\tArtifacts:         {0} -> {1}'.format(source, target))
     # URLs
     __print_if_not_suppressed('\tRoot URL:          {0}'.format(param_dict['Root URL']))
     __print_if_not_suppressed('\tTrunk URL:         {0}'.format(param_dict['Trunk URL']))
@@ -149,15 +270,30 @@ def print_script_parameters(param_dict):
     __print_if_not_suppressed('\tTag Source URL:    {0}'.format(param_dict['Tag Source URL']))
     __print_if_not_suppressed('\tTag Build URL:     {0}'.format(param_dict['Tag Build URL']))
 
+def escape_teamcity_value(value):
+    """Escape a value for use in a TeamCity service message, e.g. quotes,
+    brackets and line breaks.
+    """
+    value = '{0}'.format(value).replace('|', '||')
+    for (char, escaped) in [('\'', "|'"), ('[', '|['), (']', '|]'), ('\n', '|n'), ('\r', '|r')]:
+        value = value.replace(char, escaped)
+    return value
+
 def print_teamcity_info_message(message):
     """Print an informational TeamCity server message to stdout.
     """
-    __print_if_not_suppressed('##teamcity[message text=\'{0}\']'.format(message))
+    __print_if_not_suppressed('##teamcity[message text=\'{0}\']'.format(escape_teamcity_value(message)))
+
+def print_teamcity_verification_message(mismatch):
+    """Print a TeamCity server message with ERROR status, but without
+    failing the build, to stdout.
+    """
+    __print_if_not_suppressed('##teamcity[message text=\'Tag verification mismatch\' errorDetails=\'{0}\' status=\'ERROR\']'.format(escape_teamcity_value(mismatch)))
 
 def print_teamcity_error_message(errorDetails):
     """Print an error TeamCity server message to stdout.
     """
-    __print_if_not_suppressed('##teamcity[message text=\'Tagging process failed\' errorDetails=\'{0}\' status=\'ERROR\']'.format(errorDetails))
+    __print_if_not_suppressed('##teamcity[message text=\'Tagging process failed\' errorDetails=\'{0}\' status=\'ERROR\']'.format(escape_teamcity_value(errorDetails)))
     __print_if_not_suppressed('##teamcity[buildStatus status=\'FAILURE\']')
 
 def is_dev_tag(tag):
@@ -232,6 +368,40 @@ def remove_dev_tag(client, tagUrl):
         else:
             raise
 
+def remove_incomplete_tag(client, tagUrl):
+    """Remove a tag that was created by this run but couldn't be completed,
+    e.g. because its build artifacts couldn't be imported.
+
+    This is a clean-up after a failure, so errors are reported rather than
+    raised. Returns True if the tag was removed.
+    """
+    def log_message():
+        return (True, 'TeamCity - delete incomplete tag')
+    client.callback_get_log_message = log_message
+    __print_if_not_suppressed('Removing incomplete tag {0}'.format(tagUrl))
+    try:
+        client.remove(tagUrl)
+    except pysvn.ClientError as ce:
+        (msg, error) = ce.args[1][0]
+        __print_if_not_suppressed('\tCould not remove incomplete tag {0}: {1} ({2})'.format(tagUrl, msg, error))
+        return False
+    return True
+
+def acquire_dev_tag_lease(tagUrl):
+    """Wait for the exclusive lease on a dev tag, so that concurrent builds
+    don't remove and create the same tag at the same time.
+
+    Returns the lease, which must be released with hostlock.release_lease,
+    or None if a newer build is waiting for the same tag.
+    """
+    __print_if_not_suppressed('Waiting for lease on dev tag {0}'.format(tagUrl))
+    lease = hostlock.acquire_lease(tagUrl)
+    if lease is None:
+        __print_if_not_suppressed('A newer build is waiting to tag {0} -- skipping'.format(tagUrl))
+    else:
+        __print_if_not_suppressed('Lease on dev tag {0} obtained'.format(tagUrl))
+    return lease
+
 def __get_project_root(trunkUrl):
     """Strip /trunk from the trunk URL and return the first right-parsed partition.
     """
@@ -250,14 +420,58 @@ def __strip_build_number(version):
     (ver, _, _) = version.rpartition(VER_SEP)
     return ver
 
-def create_tag(client, name, version, trunk_url, tag_url, tag_source_url):
-    """Create a new tag.
+def get_selection_operations(trunk_url, tag_url, tag_source_url, selection):
+    """Determine how to copy selected trunk subpaths into a tag.
+
+    Returns a tuple (mkdir_urls, copies), where mkdir_urls are the directories
+    to create (parents first) in one commit and copies is a list of tuples
+    (source_urls, parent_url). Subpaths sharing a parent are copied in one
+    commit.
+    """
+    mkdir_urls = [tag_url]
+    if not tag_source_url == tag_url:
+        mkdir_urls.append(tag_source_url)
+    copies = []
+    for subpath in selection:
+        (parent, _, _) = subpath.rpartition(SVN_SEP)
+        parent_url = '{0}{1}'.format(tag_source_url, parent)
+        # Intermediate directories of nested subpaths
+        for i in range(len(parent.split(SVN_SEP))):
+            url = '{0}{1}'.format(tag_source_url, SVN_SEP.join(parent.split(SVN_SEP)[:i + 1]))
+            if url not in mkdir_urls:
+                mkdir_urls.append(url)
+        group = [(sources, url) for (sources, url) in copies if url == parent_url]
+        if group:
+            group[0][0].append('{0}{1}'.format(trunk_url, subpath))
+        else:
+            copies.append((['{0}{1}'.format(trunk_url, subpath)], parent_url))
+    return (sorted(mkdir_urls, key=len), copies)
+
+def create_tag(client, name, version, trunk_url, tag_url, tag_source_url, selection=None):
+    """Create a new tag. If a selection of trunk subpaths is given, only
+    these are copied instead of the whole trunk.
+
+    A copy can't create its parents on *nix (see below), so the tag (and any
+    parents of the subpaths) is created first, in one commit. Subpaths with
+    different parents can't be copied in one commit either. If any copy
+    fails, the tag is removed again, so that no half-populated tag is left
+    behind.
     """
     log_message_var = 'TeamCity tagging version {0}, version: {1}'.format(name, version)
     def log_message():
         return (True, log_message_var)
     client.callback_get_log_message = log_message
     try:
+        if selection:
+            (mkdir_urls, copies) = get_selection_operations(trunk_url, tag_url, tag_source_url, selection)
+            client.mkdir(mkdir_urls, log_message_var)
+            try:
+                for (source_urls, parent_url) in copies:
+                    client.copy2([(source_url,) for source_url in source_urls], parent_url, copy_as_child=True)
+            except pysvn.ClientError:
+                remove_incomplete_tag(client, tag_url)
+                raise
+            return True
         # Check whether it's needed to create the parent
         if not tag_url == tag_source_url:
             client.mkdir(tag_url, log_message_var)
@@ -274,17 +488,502 @@ def create_tag(client, name, version, trunk_url, tag_url, tag_source_url):
             raise
     return True
 
-def import_artifacts(client, name, version, build_source_full, tag_build_url):
+def import_artifacts(client, name, version, build_source_full, tag_build_url, throttle=None, total_bytes=None):
     """Import build artifacts into tag.
+
+    If throttle settings are given (see hostlock.get_throttle_settings), wait
+    for an import slot and for upload bandwidth shared with all other tagging
+    processes on this host before importing. The artifacts are only scanned
+    for their size if total_bytes isn't given (e.g. by the preflight checks).
     """
     if not os.path.exists(build_source_full):
         __print_if_not_suppressed('Build source {0} for artifacts doesn\'t exist'.format(build_source_full))
         return False
     log_message = 'TeamCity importing build artifacts for {0}, version {1}'.format(name, version)
-    revision = client.import_(build_source_full, tag_build_url, log_message)
+    slot = None
+    if throttle is not None:
+        if total_bytes is None:
+            (_, total_bytes) = scan_artifacts(build_source_full)
+        slot = __throttle_import(tag_build_url, total_bytes, throttle)
+    try:
+        revision = client.import_(build_source_full, tag_build_url, log_message)
+    finally:
+        hostlock.release_slot(slot)
     __print_if_not_suppressed('Artifacts imported at revision {0}'.format(revision.number))
     return True
 
+def __throttle_import(tag_build_url, total_bytes, throttle):
+    """Wait for an import slot and upload bandwidth. Returns the slot, which
+    must be released after the import.
+    """
+    __print_if_not_suppressed('Waiting for an import slot (maximum {0} concurrent imports)'.format(throttle['max_concurrent_imports']))
+    slot = hostlock.acquire_slot(tag_build_url, throttle['max_concurrent_imports'])
+    throttled = False
+    try:
+        delay = hostlock.consume_bandwidth(tag_build_url,
+                                           total_bytes,
+                                           throttle['bytes_per_second'],
+                                           throttle['burst_bytes'])
+        if delay > 0:
+            __print_if_not_suppressed('Delaying import of {0} bytes by {1:.1f}s to stay within {2} bytes/s'.format(total_bytes, delay, throttle['bytes_per_second']))
+            time.sleep(delay)
+        throttled = True
+    finally:
+        # The caller only releases the slot once it has it back
+        if not throttled:
+            hostlock.release_slot(slot)
+    return slot
+
+def import_artifact_roots(client, name, version, artifacts, tag_url, staging_parent, throttle=None):
+    """Import several build artifact trees into tag in a single commit.
+
+    artifacts is a list of tuples (source directory, target path in the tag).
+    The trees are staged concurrently in one temporary directory below
+    staging_parent (hard linked where possible), which is then imported.
+    staging_parent should be outside the build sources (and on the same file
+    system, for linking); the staging directory and Subversion administrative
+    directories are never staged.
+    """
+    missing = [source for (source, _) in artifacts if not os.path.exists(source)]
+    for source in missing:
+        __print_if_not_suppressed('Build source {0} for artifacts doesn\'t exist'.format(source))
+    if missing:
+        return False
+    log_message = 'TeamCity importing build artifacts for {0}, version {1}'.format(name, version)
+    staging = tempfile.mkdtemp(prefix='tagtrunk-', dir=staging_parent)
+    try:
+        def stage(artifact):
+            (source, target) = artifact
+            return __stage_artifacts(source, os.path.join(staging, *target.split(SVN_SEP)[1:]), staging)
+        pool = ThreadPool(min(SCAN_WORKERS, len(artifacts)))
+        try:
+            total_bytes = sum(pool.map(stage, artifacts))
+        finally:
+            pool.close()
+            pool.join()
+        slot = None
+        if throttle is not None:
+            slot = __throttle_import(tag_url, total_bytes, throttle)
+        try:
+            revision = client.import_(staging, tag_url, log_message)
+        finally:
+            hostlock.release_slot(slot)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    __print_if_not_suppressed('Artifacts from {0} build sources imported at revision {1}'.format(len(artifacts), revision.number))
+    return True
+
+def __stage_artifacts(source, destination, staging):
+    """Link (or, failing that, copy) a file or directory tree to destination,
+    leaving out the staging directory and administrative directories.
+    Returns the number of bytes staged.
+    """
+    if os.path.isfile(source):
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        __link_or_copy(source, destination)
+        return os.lstat(source).st_size
+    total_bytes = 0
+    staging = os.path.abspath(staging)
+    for (dirpath, dirnames, filenames) in os.walk(source):
+        dirnames[:] = [d for d in dirnames
+                       if not d == SVN_ADMIN_DIR and not os.path.abspath(os.path.join(dirpath, d)) == staging]
+        targetDir = os.path.join(destination, os.path.relpath(dirpath, source))
+        if not os.path.isdir(targetDir):
+            os.makedirs(targetDir)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            __link_or_copy(path, os.path.join(targetDir, filename))
+            total_bytes += os.lstat(path).st_size
+    return total_bytes
+
+def __link_or_copy(source, destination):
+    """Hard link a file, or copy it if linking isn't possible (e.g. across
+    file systems).
+    """
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copy2(source, destination)
+
+def watch_artifacts(client, name, version, build_source_full, tag_build_url, marker, throttle=None):
+    """Import build artifacts into tag while the build is still writing them.
+
+    The tag's (new) build directory is checked out into a temporary working
+    copy. On every poll, files whose size and modification time didn't change
+    since the previous poll are copied into the working copy and committed
+    together. Once the marker file exists the build is complete: all
+    remaining files are committed, together with the removal of files that
+    were committed earlier but no longer exist (e.g. intermediate files).
+
+    Returns False if the build source doesn't exist once the build is complete,
+    or if the build didn't complete within WATCH_TIMEOUT.
+    """
+    log_message = 'TeamCity importing build artifacts for {0}, version {1}'.format(name, version)
+    __print_if_not_suppressed('Watching {0} for build artifacts until {1} exists'.format(build_source_full, marker))
+    client.mkdir(tag_build_url, log_message)
+    wc = tempfile.mkdtemp(prefix='tagtrunk-')
+    try:
+        client.checkout(tag_build_url, wc)
+        started = time.time()
+        uploaded = {}
+        previous = {}
+        while True:
+            complete = os.path.exists(marker)
+            current = __stat_tree(build_source_full, marker)
+            ready = [relpath for (relpath, stat) in current.items()
+                     if not uploaded.get(relpath) == stat and (complete or previous.get(relpath) == stat)]
+            deleted = []
+            if complete:
+                deleted = [relpath for relpath in uploaded if relpath not in current]
+            if ready or deleted:
+                __commit_artifacts(client, build_source_full, wc, sorted(ready), sorted(deleted), current, log_message, tag_build_url, throttle)
+                for relpath in ready:
+                    uploaded[relpath] = current[relpath]
+                for relpath in deleted:
+                    del uploaded[relpath]
+            if complete:
+                break
+            if time.time() - started > WATCH_TIMEOUT:
+                __print_if_not_suppressed('Build didn\'t complete within {0}s'.format(WATCH_TIMEOUT))
+                return False
+            previous = current
+            time.sleep(WATCH_INTERVAL)
+    finally:
+        shutil.rmtree(wc, ignore_errors=True)
+    if not os.path.exists(build_source_full):
+        __print_if_not_suppressed('Build source {0} for artifacts doesn\'t exist'.format(build_source_full))
+        return False
+    __print_if_not_suppressed('{0} artifacts imported'.format(len(uploaded)))
+    return True
+
+def __stat_tree(directory, exclude):
+    """Return the size and modification time of every file in a directory
+    tree, keyed by relative path, leaving out the exclude path and
+    administrative directories (which Subversion never imports).
+    """
+    stats = {}
+    exclude = os.path.abspath(exclude)
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d == SVN_ADMIN_DIR]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.abspath(path) == exclude:
+                continue
+            st = os.lstat(path)
+            stats[os.path.relpath(path, directory)] = (st.st_size, st.st_mtime)
+    return stats
+
+def __commit_artifacts(client, build_source_full, wc, relpaths, deleted, stats, log_message, tag_build_url, throttle):
+    """Copy files from the build source into the working copy, add the new
+    ones, remove the deleted ones and commit them all at once.
+    """
+    for relpath in deleted:
+        client.remove(os.path.join(wc, relpath))
+    for relpath in relpaths:
+        destination = os.path.join(wc, relpath)
+        isNew = not os.path.exists(destination)
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        shutil.copy2(os.path.join(build_source_full, relpath), destination)
+        if isNew:
+            client.add(destination, add_parents=True)
+    slot = None
+    if throttle is not None:
+        slot = __throttle_import(tag_build_url, sum([stats[relpath][0] for relpath in relpaths]), throttle)
+    try:
+        revision = client.checkin([wc], log_message)
+    finally:
+        hostlock.release_slot(slot)
+    # Nothing is committed if only modification times changed
+    if revision is None:
+        __print_if_not_suppressed('{0} artifacts unchanged'.format(len(relpaths)))
+        return
+    __print_if_not_suppressed('{0} artifacts committed and {1} removed at revision {2}'.format(len(relpaths), len(deleted), revision.number))
+
+def verify_artifacts(client, artifacts, tag_url, exclude=None):
+    """Check that the artifacts in a tag match the build sources on disk.
+
+    artifacts is a list of tuples (source directory, target path in the tag).
+    The tag is listed recursively, with sizes, in one call per target, while
+    the build sources are scanned concurrently. The exclude path (e.g. the
+    watch mode marker) is left out.
+
+    Returns a list of mismatches, which is empty if the tag matches.
+    """
+    __print_if_not_suppressed('Verifying artifacts in tag {0}'.format(tag_url))
+    pool = ThreadPool(min(SCAN_WORKERS, len(artifacts)))
+    try:
+        manifests = pool.map(lambda source: __get_local_manifest(source, exclude), [source for (source, _) in artifacts])
+    finally:
+        pool.close()
+        pool.join()
+    mismatches = []
+    for ((source, target), local) in zip(artifacts, manifests):
+        url = normalise_url('{0}{1}'.format(tag_url, target))
+        remote = __get_remote_manifest(client, url)
+        for relpath in sorted(set(local) | set(remote)):
+            name = '{0}/{1}'.format(url, relpath) if relpath else url
+            if relpath not in remote:
+                mismatches.append('{0} is missing'.format(name))
+            elif relpath not in local:
+                # The tag's root also holds the source code
+                if not target == SVN_SEP:
+                    mismatches.append('{0} doesn\'t exist in {1}'.format(name, source))
+            elif not local[relpath] == remote[relpath]:
+                mismatches.append('{0} is {1} bytes instead of {2}'.format(name, remote[relpath], local[relpath]))
+    for mismatch in mismatches:
+        __print_if_not_suppressed('\t{0}'.format(mismatch))
+    return mismatches
+
+def __get_local_manifest(source, exclude):
+    """Return the size of every file below source, keyed by the relative
+    path with forward slashes (or an empty path if source is a file).
+    """
+    if os.path.isfile(source):
+        return {'': os.lstat(source).st_size}
+    if exclude is None:
+        exclude = ''
+    return dict([(relpath.replace(os.sep, SVN_SEP), stat[0])
+                 for (relpath, stat) in __stat_tree(source, exclude).items()])
+
+def __get_remote_manifest(client, url):
+    """Return the size of every file below a URL, keyed by the relative
+    path (or an empty path if the URL is a file).
+    """
+    manifest = {}
+    try:
+        entries = client.list(url,
+                              recurse=True,
+                              dirent_fields=pysvn.SVN_DIRENT_KIND | pysvn.SVN_DIRENT_SIZE)
+    except pysvn.ClientError as ce:
+        (msg, error) = ce.args[1][0]
+        if error == svnerr.FS_NOT_FOUND or error == svnerr.RA_ILLEGAL_URL:
+            return manifest
+        raise
+    for (entry, _) in entries:
+        if not entry['kind'] == pysvn.node_kind.file:
+            continue
+        manifest[entry['path'][len(url):].lstrip(SVN_SEP)] = entry['size']
+    return manifest
+
+def path_exists(client, url):
+    """Check whether a URL exists in the repository.
+    """
+    try:
+        client.info2(url, recurse=False)
+    except pysvn.ClientError as ce:
+        (msg, error) = ce.args[1][0]
+        if error == svnerr.FS_NOT_FOUND or error == svnerr.RA_ILLEGAL_URL:
+            return False
+        raise
+    return True
+
+def __scan_dir(directory):
+    """Walk a directory and return a tuple (file_count, total_bytes),
+    leaving out administrative directories (which are never imported).
+    """
+    file_count = 0
+    total_bytes = 0
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d == SVN_ADMIN_DIR]
+        for filename in filenames:
+            file_count += 1
+            total_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+    return (file_count, total_bytes)
+
+def scan_artifacts(build_source_full):
+    """Count the files and bytes in an artifact tree, as they would be
+    imported. The top-level subdirectories are walked in parallel.
+
+    Returns a tuple (file_count, total_bytes), which is (0, 0) if the
+    path doesn't exist.
+    """
+    if os.path.isfile(build_source_full):
+        return (1, os.lstat(build_source_full).st_size)
+    if not os.path.isdir(build_source_full):
+        return (0, 0)
+    file_count = 0
+    total_bytes = 0
+    subdirs = []
+    for entry in os.listdir(build_source_full):
+        path = os.path.join(build_source_full, entry)
+        if entry == SVN_ADMIN_DIR:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            subdirs.append(path)
+        else:
+            file_count += 1
+            total_bytes += os.lstat(path).st_size
+    if subdirs:
+        pool = ThreadPool(min(SCAN_WORKERS, len(subdirs)))
+        try:
+            results = pool.map(__scan_dir, subdirs)
+        finally:
+            pool.close()
+            pool.join()
+        for (count, size) in results:
+            file_count += count
+            total_bytes += size
+    return (file_count, total_bytes)
+
+def scan_artifact_roots(artifacts):
+    """Scan several artifact trees concurrently. artifacts is a list of
+    tuples (source directory, target path).
+
+    Returns a list of tuples (file_count, total_bytes) in the same order.
+    """
+    if len(artifacts) == 1:
+        return [scan_artifacts(artifacts[0][0])]
+    pool = ThreadPool(min(SCAN_WORKERS, len(artifacts)))
+    try:
+        return pool.map(scan_artifacts, [source for (source, _) in artifacts])
+    finally:
+        pool.close()
+        pool.join()
+
+def plan_tagging(client, param_dict, changelog=False, marker=None):
+    """Determine all operations a tagging run would perform, without
+    writing anything to the repository. changelog and marker are the
+    --changelog and --watch options of the run.
+
+    Returns a dictionary that can be serialised as JSON. When watching the
+    build, the number of commits depends on how the build writes its
+    artifacts, so it is the minimum and the plan is marked as an estimate.
+    """
+    __print_if_not_suppressed('Planning tagging operations')
+    operations = []
+    tag_exists = path_exists(client, param_dict['Tag URL'])
+    if is_dev_tag(param_dict['Tag Type']) and tag_exists:
+        operations.append({'operation': 'remove',
+                           'url': param_dict['Tag URL']})
+    sharded = is_sharded_layout()
+    if sharded and not path_exists(client, __get_parent_url(param_dict['Tag URL'])):
+        operations.append({'operation': 'mkdir',
+                           'url': __get_parent_url(param_dict['Tag URL'])})
+    if param_dict['Selection']:
+        (mkdir_urls, copies) = get_selection_operations(param_dict['Trunk URL'],
+                                                        param_dict['Tag URL'],
+                                                        param_dict['Tag Source URL'],
+                                                        param_dict['Selection'])
+        operations.append({'operation': 'mkdir',
+                           'url': mkdir_urls})
+        for (source_urls, parent_url) in copies:
+            operations.append({'operation': 'copy',
+                               'from': source_urls,
+                               'to': parent_url})
+    else:
+        if not param_dict['Tag URL'] == param_dict['Tag Source URL']:
+            operations.append({'operation': 'mkdir',
+                               'url': param_dict['Tag URL']})
+        operations.append({'operation': 'copy',
+                           'from': param_dict['Trunk URL'],
+                           'to': param_dict['Tag Source URL']})
+    scans = scan_artifact_roots(param_dict['Artifacts'])
+    file_count = sum([count for (count, _) in scans])
+    total_bytes = sum([size for (_, size) in scans])
+    if len(param_dict['Artifacts']) > 1:
+        operations.append({'operation': 'import',
+                           'from': [source for (source, _) in param_dict['Artifacts']],
+                           'to': param_dict['Tag URL']})
+    elif marker is not None:
+        operations.append({'operation': 'mkdir',
+                           'url': param_dict['Tag Build URL']})
+        # One commit per batch of stable files, at least one
+        operations.append({'operation': 'watch',
+                           'from': param_dict['Build Source Full'],
+                           'to': param_dict['Tag Build URL'],
+                           'marker': marker})
+    elif os.path.exists(param_dict['Build Source Full']):
+        operations.append({'operation': 'import',
+                           'from': param_dict['Build Source Full'],
+                           'to': param_dict['Tag Build URL']})
+    if changelog:
+        operations.append({'operation': 'import',
+                           'from': CHANGELOG_NAME,
+                           'to': '{0}/{1}'.format(param_dict['Tag URL'], CHANGELOG_NAME)})
+    if sharded:
+        operations.append({'operation': 'index',
+                           'url': '{0}/{1}'.format(get_tags_url(param_dict['Root URL']), TAG_INDEX_NAME)})
+    # Every operation above is a separate commit
+    return {'name': param_dict['Name'],
+            'version': param_dict['Version'],
+            'tag_type': param_dict['Tag Type'],
+            'tag_url': param_dict['Tag URL'],
+            'tag_exists': tag_exists,
+            'operations': operations,
+            'commits': len(operations),
+            'estimate': marker is not None,
+            'artifact_files': file_count,
+            'artifact_bytes': total_bytes}
+
+def __get_parent_url(url):
+    """Return the parent of a given URL.
+    """
+    (parentUrl, _, _) = url.rpartition(SVN_SEP)
+    return parentUrl
+
+def preflight_checks(client, param_dict, require_artifacts=True, marker=None):
+    """Check up front, before anything is written to the repository, that
+    the tagging run can succeed. All checks are run and all failures are
+    reported together. The build source needn't exist yet if
+    require_artifacts is False (i.e. when watching the build). The marker
+    of a watched build mustn't exist yet, as it would be left over from a
+    previous build and make the new one look complete.
+
+    Returns a tuple (valid, errorMessage), where valid=True/False
+    and errorMessage will be populated if invalid (or valid=False)
+
+    NOTE: This method stores the total size of the build sources in
+    param_dict['Artifact Bytes'] and the import throttling settings in
+    param_dict['Throttle']!
+    """
+    __print_if_not_suppressed('Running preflight checks')
+    errors = []
+    tagsUrl = get_tags_url(param_dict['Root URL'])
+    if not path_exists(client, tagsUrl):
+        errors.append('Tags path {0} doesn\'t exist'.format(tagsUrl))
+    # A dev tag gets replaced, any other tag must be new
+    if not is_dev_tag(param_dict['Tag Type']) and path_exists(client, param_dict['Tag URL']):
+        errors.append('Tag {0} already exists'.format(param_dict['Tag URL']))
+    # The tag is copied from trunk at HEAD, not at the working copy's revision
+    if not path_exists(client, param_dict['Trunk URL']):
+        errors.append('Trunk {0} is not reachable'.format(param_dict['Trunk URL']))
+    else:
+        for subpath in param_dict['Selection']:
+            if not path_exists(client, '{0}{1}'.format(param_dict['Trunk URL'], subpath)):
+                errors.append('Selected trunk subpath {0} doesn\'t exist'.format(subpath))
+    scans = scan_artifact_roots(param_dict['Artifacts'])
+    param_dict['Artifact Bytes'] = sum([total_bytes for (_, total_bytes) in scans])
+    try:
+        param_dict['Throttle'] = hostlock.get_throttle_settings(param_dict['Tag URL'])
+    except ValueError as ex:
+        param_dict['Throttle'] = None
+        errors.append('Invalid throttling configuration {0}'.format(ex))
+    for ((source, _), (file_count, total_bytes)) in zip(param_dict['Artifacts'], scans):
+        if os.path.exists(source):
+            __print_if_not_suppressed('\tBuild source {0} contains {1} files ({2} bytes)'.format(source, file_count, total_bytes))
+        elif require_artifacts:
+            errors.append('Build source {0} for artifacts doesn\'t exist'.format(source))
+    if marker is not None and os.path.exists(marker):
+        errors.append('Build completion marker {0} already exists'.format(marker))
+    for error in errors:
+        __print_if_not_suppressed('\t{0}'.format(error))
+    return (len(errors) == 0, '; '.join(errors))
+
+def write_json(document, path):
+    """Write a document as JSON to a file, or as a single line to stdout if
+    the path is JSON_STDOUT.
+    """
+    document = json.dumps(document, sort_keys=True)
+    if path == JSON_STDOUT:
+        print(document)
+    else:
+        with open(path, 'w') as f:
+            f.write(document)
+            f.write('\n')
+        __print_if_not_suppressed('Written to {0}'.format(path))
+
 def assign_params(svn_info, args, param_dict):
     """Assign parameters from various sources, such as repository information and command-line arguments.
 
@@ -301,7 +1000,9 @@ def assign_params(svn_info, args, param_dict):
     else:
         param_dict['Tag Type'] = args.T
     # Normalise (if required) and assign all paths
-    param_dict['Source'] = normalise_relative_path(args.S)
+    (source, _, selection) = args.S.partition(':')
+    param_dict['Source'] = normalise_relative_path(source)
+    param_dict['Selection'] = [normalise_relative_path(subpath) for subpath in selection.split(',') if selection]
     param_dict['Build'] = normalise_relative_path(args.B)
     param_dict['Build Source'] = args.BS
     # Strip build number in case of dev tag
@@ -312,9 +1013,14 @@ def assign_params(svn_info, args, param_dict):
     param_dict['Trunk URL'] = svn_info['trunk_url']
     param_dict['Trunk'] = svn_info['trunk_dir']
     param_dict['Build Source Full'] = os.path.join(param_dict['Trunk'], param_dict['Build Source'])
+    # Build artifact trees and their targets in the tag
+    param_dict['Artifacts'] = [(param_dict['Build Source Full'], param_dict['Build'])]
+    for mapping in args.artifacts or []:
+        (source, _, target) = mapping.rpartition('=')
+        param_dict['Artifacts'].append((os.path.join(param_dict['Trunk'], source), normalise_relative_path(target)))
     param_dict['Root URL'] = __get_project_root(param_dict['Trunk URL'])
     param_dict['Name'] = __get_project_name(param_dict['Root URL'])
-    param_dict['Tag URL'] = '{0}/tags/{1}-{2}-{3}'.format(param_dict['Root URL'], param_dict['Name'], param_dict['Version'], param_dict['Tag Type'])
+    param_dict['Tag URL'] = get_tag_url(param_dict['Root URL'], param_dict['Name'], param_dict['Version'], param_dict['Tag Type'], is_sharded_layout())
     param_dict['Tag Build URL'] = '{0}{1}'.format(param_dict['Tag URL'], param_dict['Build'])
     param_dict['Tag Source URL'] = normalise_url('{0}{1}'.format(param_dict['Tag URL'], param_dict['Source']))
 
@@ -325,3 +1031,513 @@ def normalise_url(path):
     if path.endswith(SVN_SEP):
         return path[:-1]
     return path
+
+def is_sharded_layout():
+    """Check whether the tags directory uses the sharded layout (see
+    TAG_LAYOUT).
+    """
+    return os.getenv(TAG_LAYOUT) == SHARDED_LAYOUT
+
+def get_tags_url(root_url):
+    """Return the URL of a project's tags directory.
+    """
+    return '{0}/tags'.format(root_url)
+
+def get_tag_name(name, version, tag_type):
+    """Return the name of a tag, i.e. <name>-<version>-<type>.
+    """
+    return '{0}{1}{2}{1}{3}'.format(name, TAG_SEP, version, tag_type)
+
+def get_shard_path(version):
+    """Return the shard of a version relative to the tags directory, i.e.
+    <major>/<major>.<minor>.
+    """
+    (major, minor) = version.split(VER_SEP)[:2]
+    return '{0}{1}{0}{2}{3}'.format(major, SVN_SEP, VER_SEP, minor)
+
+def get_tag_url(root_url, name, version, tag_type, sharded=False):
+    """Return the URL of a project's tag, either directly in the tags
+    directory or in its shard.
+    """
+    tag_name = get_tag_name(name, version, tag_type)
+    if sharded:
+        return '{0}/{1}/{2}'.format(get_tags_url(root_url), get_shard_path(version), tag_name)
+    return '{0}/{1}'.format(get_tags_url(root_url), tag_name)
+
+def create_shard(client, tag_url):
+    """Create the shard directory of a tag (and its parent) if it doesn't
+    exist yet.
+    """
+    shard_url = __get_parent_url(tag_url)
+    if path_exists(client, shard_url):
+        return
+    __print_if_not_suppressed('Creating shard {0}'.format(shard_url))
+    try:
+        client.mkdir(shard_url, 'TeamCity creating tag shard', make_parents=True)
+    except pysvn.ClientError as ce:
+        (msg, error) = ce.args[1][0]
+        # Another build may have created it in the meantime
+        if not error == svnerr.FS_ALREADY_EXISTS:
+            raise
+
+def read_tag_index(client, tags_url):
+    """Read the index of a sharded tags directory.
+
+    Returns a dictionary of tag names to paths relative to the tags directory,
+    which is empty if there is no index yet.
+    """
+    try:
+        content = client.cat('{0}/{1}'.format(tags_url, TAG_INDEX_NAME))
+    except pysvn.ClientError as ce:
+        (msg, error) = ce.args[1][0]
+        if error == svnerr.FS_NOT_FOUND or error == svnerr.RA_ILLEGAL_URL:
+            return {}
+        raise
+    return __parse_tag_index(content)
+
+def __parse_tag_index(content):
+    """Parse the lines <tag name><tab><relative path> of a tag index.
+    """
+    if not isinstance(content, str):
+        content = content.decode('utf-8')
+    index = {}
+    for line in content.splitlines():
+        (tag_name, _, path) = line.partition('\t')
+        if path:
+            index[tag_name] = path
+    return index
+
+def __format_tag_index(index):
+    """Format a tag index as sorted lines <tag name><tab><relative path>.
+    """
+    return ''.join(['{0}\t{1}\n'.format(tag_name, index[tag_name]) for tag_name in sorted(index)])
+
+def update_tag_index(client, tags_url, entries, log_message):
+    """Add entries (tag names to paths relative to the tags directory) to
+    the index of a sharded tags directory.
+
+    Only the index file is checked out. If another build commits the index in
+    the meantime, the update is retried.
+    """
+    __print_if_not_suppressed('Updating tag index {0}/{1}'.format(tags_url, TAG_INDEX_NAME))
+    for attempt in range(TAG_INDEX_ATTEMPTS):
+        wc = tempfile.mkdtemp(prefix='tagtrunk-')
+        try:
+            client.checkout(tags_url, wc, depth=pysvn.depth.empty)
+            path = os.path.join(wc, TAG_INDEX_NAME)
+            client.update(path)
+            isNew = not os.path.exists(path)
+            index = {}
+            if not isNew:
+                with open(path) as f:
+                    index = __parse_tag_index(f.read())
+            if all([index.get(tag_name) == entries[tag_name] for tag_name in entries]):
+                __print_if_not_suppressed('\tTag index is up to date')
+                return
+            index.update(entries)
+            with open(path, 'w') as f:
+                f.write(__format_tag_index(index))
+            if isNew:
+                client.add(path)
+            try:
+                revision = client.checkin([path], log_message)
+            except pysvn.ClientError as ce:
+                errors = [error for (_, error) in ce.args[1]]
+                if svnerr.FS_TXN_OUT_OF_DATE in errors or svnerr.FS_CONFLICT in errors or svnerr.FS_ALREADY_EXISTS in errors:
+                    __print_if_not_suppressed('\tTag index changed by another build -- retrying')
+                    continue
+                raise
+            __print_if_not_suppressed('\tTag index updated at revision {0}'.format(revision.number))
+            return
+        finally:
+            shutil.rmtree(wc, ignore_errors=True)
+    raise RuntimeError('Could not update tag index {0}/{1} after {2} attempts'.format(tags_url, TAG_INDEX_NAME, TAG_INDEX_ATTEMPTS))
+
+def index_tag(client, root_url, tag_url):
+    """Add a tag in a sharded tags directory to the tag index.
+    """
+    tags_url = get_tags_url(root_url)
+    update_tag_index(client,
+                     tags_url,
+                     {tag_url.rpartition(SVN_SEP)[2]: tag_url[len(tags_url) + len(SVN_SEP):]},
+                     'TeamCity indexing tag {0}'.format(tag_url))
+
+def plan_migration(client, root_url, name):
+    """Find the tags of a project directly in its tags directory and their
+    shards in the sharded layout.
+
+    Returns a list of tuples (tag name, shard path), sorted by tag name.
+    """
+    tags_url = get_tags_url(root_url)
+    migration = []
+    for (entry, _) in client.list(tags_url, recurse=False):
+        tag_name = entry['path'].rpartition(SVN_SEP)[2]
+        parsed = __parse_tag_name(tag_name, name)
+        if parsed is None or len(parsed[0]) < 2:
+            continue
+        (version, _, _) = tag_name[len(name) + len(TAG_SEP):].rpartition(TAG_SEP)
+        migration.append((tag_name, get_shard_path(version)))
+    return sorted(migration)
+
+def find_unindexed_tags(client, root_url, name):
+    """Find the tags of a project in their shards that are missing from the
+    tag index, e.g. because an earlier migration was interrupted.
+
+    Returns a dictionary of tag names to paths relative to the tags directory.
+    """
+    tags_url = get_tags_url(root_url)
+    index = read_tag_index(client, tags_url)
+    unindexed = {}
+    for major in __list_names(client, tags_url):
+        if not major.isdigit():
+            continue
+        for minor in __list_names(client, '{0}/{1}'.format(tags_url, major)):
+            shard = '{0}{1}{2}'.format(major, SVN_SEP, minor)
+            for tag_name in __list_names(client, '{0}/{1}'.format(tags_url, shard)):
+                if __parse_tag_name(tag_name, name) is not None and tag_name not in index:
+                    unindexed[tag_name] = '{0}{1}{2}'.format(shard, SVN_SEP, tag_name)
+    return unindexed
+
+def __list_names(client, url):
+    """Return the names of the immediate children of a repository directory.
+    """
+    return [entry['path'].rpartition(SVN_SEP)[2]
+            for (entry, _) in client.list(url, recurse=False) if entry['path'] != url]
+
+def print_migration(migration, unindexed=None):
+    """Print where tags will be moved and which tags will be indexed to stdout.
+    """
+    __print_if_not_suppressed('Tags to migrate')
+    for (tag_name, shard) in migration:
+        __print_if_not_suppressed('\t{0} -> {1}/{0}'.format(tag_name, shard))
+    if unindexed:
+        __print_if_not_suppressed('Tags to index')
+        for tag_name in sorted(unindexed):
+            __print_if_not_suppressed('\t{0}'.format(unindexed[tag_name]))
+
+def migrate_tags(client, root_url, migration, unindexed=None):
+    """Move tags from the tags directory into their shards and add them to
+    the tag index. All shards are created in one commit, and the tags of a
+    shard are moved together in one commit.
+
+    The index is updated after each shard's move, so an interrupted migration
+    leaves at most one shard unindexed. Tags in unindexed (see
+    find_unindexed_tags) are indexed before anything is moved.
+    """
+    tags_url = get_tags_url(root_url)
+    if unindexed:
+        update_tag_index(client, tags_url, unindexed, 'TeamCity indexing migrated tags')
+    shards = sorted(set([shard for (_, shard) in migration]))
+    new_shards = ['{0}/{1}'.format(tags_url, shard) for shard in shards
+                  if not path_exists(client, '{0}/{1}'.format(tags_url, shard))]
+    if new_shards:
+        __print_if_not_suppressed('Creating {0} shards'.format(len(new_shards)))
+        client.mkdir(new_shards, 'TeamCity creating tag shards', make_parents=True)
+    log_message_var = 'TeamCity moving tags into shards'
+    def log_message():
+        return (True, log_message_var)
+    client.callback_get_log_message = log_message
+    for shard in shards:
+        tag_names = [tag_name for (tag_name, tag_shard) in migration if tag_shard == shard]
+        __print_if_not_suppressed('Moving {0} tags into {1}'.format(len(tag_names), shard))
+        client.move2([('{0}/{1}'.format(tags_url, tag_name),) for tag_name in tag_names],
+                     '{0}/{1}'.format(tags_url, shard),
+                     move_as_child=True)
+        update_tag_index(client,
+                         tags_url,
+                         dict([(tag_name, '{0}/{1}'.format(shard, tag_name)) for tag_name in tag_names]),
+                         'TeamCity indexing migrated tags')
+
+def assign_project_params(svn_info, param_dict):
+    """Assign the project's root URL and name from repository information.
+
+    NOTE: This method modifies param_dict!
+    """
+    param_dict['Root URL'] = __get_project_root(svn_info['trunk_url'])
+    param_dict['Name'] = __get_project_name(param_dict['Root URL'])
+
+def assign_compare_params(svn_info, args, param_dict):
+    """Assign the parameters for comparing two tags from repository information
+    and command-line arguments.
+
+    NOTE: This method modifies param_dict!
+    """
+    (source, _, _) = args.S.partition(':')
+    param_dict['Source'] = normalise_relative_path(source)
+    param_dict['Build'] = normalise_relative_path(args.B)
+    assign_project_params(svn_info, param_dict)
+    for (key, spec) in [('From', args.FROM), ('To', args.TO)]:
+        (version, _, tag_type) = spec.rpartition(TAG_SEP)
+        param_dict['{0} Tag URL'.format(key)] = get_tag_url(param_dict['Root URL'], param_dict['Name'], version, tag_type, is_sharded_layout())
+
+def get_cache_path(kind, key):
+    """Return the path of an entry in the local cache, creating the cache
+    directory if required. The key is hashed to form the file name.
+    """
+    cacheDir = os.getenv(CACHE_DIR)
+    if not cacheDir:
+        cacheDir = os.path.join(os.path.expanduser('~'), '.tagtrunk', 'cache')
+    cacheDir = os.path.join(cacheDir, kind)
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            if not os.path.isdir(cacheDir):
+                raise
+    return os.path.join(cacheDir, '{0}.json'.format(hashlib.md5(key.encode('utf-8')).hexdigest()))
+
+def read_cache(path):
+    """Return a cached JSON document, or None if it isn't cached (or is
+    unreadable).
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def write_cache(path, document):
+    """Store a JSON document in the cache. The file is replaced atomically so
+    that concurrent readers never see a partial document.
+    """
+    temp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump(document, f, sort_keys=True)
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(temp, path)
+
+def get_last_changed_revision(client, url):
+    """Return the revision number in which a URL was last changed.
+    """
+    (_, info) = client.info2(url, recurse=False)[0]
+    return info['last_changed_rev'].number
+
+def compare_tags(client, from_tag_url, to_tag_url, source, build):
+    """Compare two tags: a server-side diff summary of the source directory
+    and a comparison of the file listings (with sizes) of the build directory.
+
+    Since tags are in effect immutable, the comparison is cached, keyed by
+    the tag URLs and their last changed revisions.
+
+    Returns a dictionary that can be serialised as JSON.
+    """
+    __print_if_not_suppressed('Comparing {0} with {1}'.format(from_tag_url, to_tag_url))
+    from_revision = get_last_changed_revision(client, from_tag_url)
+    to_revision = get_last_changed_revision(client, to_tag_url)
+    key = '|'.join([from_tag_url, str(from_revision), to_tag_url, str(to_revision), source, build])
+    cachePath = get_cache_path('compare', key)
+    report = read_cache(cachePath)
+    if report is not None:
+        __print_if_not_suppressed('\tUsing cached comparison')
+        return report
+    report = {'from': from_tag_url,
+              'from_revision': from_revision,
+              'to': to_tag_url,
+              'to_revision': to_revision,
+              'source': __compare_sources(client,
+                                          normalise_url('{0}{1}'.format(from_tag_url, source)), from_revision,
+                                          normalise_url('{0}{1}'.format(to_tag_url, source)), to_revision),
+              'build': __compare_builds(__get_remote_manifest(client, '{0}{1}'.format(from_tag_url, build)),
+                                        __get_remote_manifest(client, '{0}{1}'.format(to_tag_url, build)))}
+    write_cache(cachePath, report)
+    return report
+
+def __compare_sources(client, from_url, from_revision, to_url, to_revision):
+    """Summarise the differences between two source directories on the server.
+    """
+    summary = client.diff_summarize(from_url,
+                                    pysvn.Revision(pysvn.opt_revision_kind.number, from_revision),
+                                    to_url,
+                                    pysvn.Revision(pysvn.opt_revision_kind.number, to_revision),
+                                    recurse=True)
+    changes = []
+    for entry in summary:
+        if entry['summarize_kind'] == pysvn.diff_summarize_kind.normal and not entry['prop_changed']:
+            continue
+        changes.append({'path': entry['path'],
+                        'change': str(entry['summarize_kind'])})
+    return sorted(changes, key=lambda change: change['path'])
+
+def __compare_builds(from_manifest, to_manifest):
+    """Compare two build directory manifests (file sizes keyed by path).
+    """
+    changes = []
+    for path in sorted(set(from_manifest) | set(to_manifest)):
+        if path not in from_manifest:
+            changes.append({'path': path, 'change': 'added'})
+        elif path not in to_manifest:
+            changes.append({'path': path, 'change': 'deleted'})
+        elif not from_manifest[path] == to_manifest[path]:
+            changes.append({'path': path, 'change': 'modified'})
+    return changes
+
+def print_comparison(report):
+    """Print a tag comparison to stdout.
+    """
+    __print_if_not_suppressed('Comparison of {0}@{1} with {2}@{3}'.format(report['from'], report['from_revision'], report['to'], report['to_revision']))
+    for part in ['source', 'build']:
+        __print_if_not_suppressed('\t{0} ({1} changes)'.format(part.capitalize(), len(report[part])))
+        for change in report[part]:
+            __print_if_not_suppressed('\t\t{0:<10} {1}'.format(change['change'], change['path']))
+
+def __parse_tag_name(tag_name, name):
+    """Split a tag name <name>-<version>-<type> of the given project into a
+    tuple (version, tag_type), where version is a tuple of integers.
+
+    Returns None if the tag name isn't of this project or malformed.
+    """
+    prefix = '{0}{1}'.format(name, TAG_SEP)
+    if not tag_name.startswith(prefix):
+        return None
+    (version, _, tag_type) = tag_name[len(prefix):].rpartition(TAG_SEP)
+    parts = version.split(VER_SEP)
+    if tag_type == '' or not all([part.isdigit() for part in parts]):
+        return None
+    return (tuple([int(part) for part in parts]), tag_type)
+
+def find_previous_tag(client, root_url, name, version, tag_type):
+    """Find the latest tag of the same type with a lower version.
+
+    Returns the tag's URL, or None if there is no such tag.
+    """
+    tags_url = get_tags_url(root_url)
+    current = tuple([int(part) for part in version.split(VER_SEP)])
+    previous = None
+    # The index of a sharded layout saves listing every shard
+    if is_sharded_layout():
+        tags = read_tag_index(client, tags_url).items()
+    else:
+        tags = [(entry['path'].rpartition(SVN_SEP)[2],) * 2 for (entry, _) in client.list(tags_url, recurse=False)]
+    for (tag_name, path) in tags:
+        parsed = __parse_tag_name(tag_name, name)
+        if parsed is None or not parsed[1] == tag_type or not parsed[0] < current:
+            continue
+        if previous is None or parsed[0] > previous[0]:
+            previous = (parsed[0], '{0}/{1}'.format(tags_url, path))
+    if previous is None:
+        return None
+    return previous[1]
+
+def get_copy_revision(client, tag_url, trunk_url):
+    """Return the trunk revision a tag was copied from.
+
+    Only copies from trunk (or from below it, for a selection of subpaths)
+    count. If the tag was moved, e.g. by tagmigrate.py, its history is
+    followed across the move(s) back to the copy from trunk.
+    """
+    root_url = client.root_url_from_path(tag_url)
+    trunk_path = trunk_url[len(root_url):]
+    url = tag_url
+    revision = pysvn.Revision(pysvn.opt_revision_kind.head)
+    while True:
+        copy_revision = None
+        moved_from = None
+        for entry in client.log(url,
+                                revision_start=revision,
+                                peg_revision=revision,
+                                strict_node_history=True,
+                                discover_changed_paths=True):
+            for changed_path in entry['changed_paths']:
+                copyfrom_path = changed_path['copyfrom_path']
+                if copyfrom_path is None:
+                    continue
+                copyfrom_revision = changed_path['copyfrom_revision'].number
+                if copyfrom_path == trunk_path or copyfrom_path.startswith(trunk_path + SVN_SEP):
+                    copy_revision = max(copy_revision or 0, copyfrom_revision)
+                elif changed_path['path'] == url[len(root_url):]:
+                    moved_from = (copyfrom_path, copyfrom_revision)
+        if copy_revision is not None:
+            return copy_revision
+        if moved_from is None:
+            return None
+        # Copy revisions only go back in time, so this ends
+        (path, number) = moved_from
+        url = '{0}{1}'.format(root_url, path)
+        revision = pysvn.Revision(pysvn.opt_revision_kind.number, number)
+
+def get_trunk_log(client, trunk_url, start, end):
+    """Return the trunk log entries with start < revision <= end, oldest first.
+
+    The entries are kept in a local cache per trunk URL, which only gets
+    extended with the revisions it doesn't cover yet.
+    """
+    cachePath = get_cache_path('log', trunk_url)
+    cache = read_cache(cachePath)
+    if cache is None:
+        cache = {'first': end + 1, 'last': end, 'entries': []}
+    updated = False
+    if start + 1 < cache['first']:
+        cache['entries'] = __fetch_log(client, trunk_url, start + 1, cache['first'] - 1) + cache['entries']
+        cache['first'] = start + 1
+        updated = True
+    if end > cache['last']:
+        cache['entries'] = cache['entries'] + __fetch_log(client, trunk_url, cache['last'] + 1, end)
+        cache['last'] = end
+        updated = True
+    if updated:
+        write_cache(cachePath, cache)
+    else:
+        __print_if_not_suppressed('\tUsing cached log of {0}'.format(trunk_url))
+    return [entry for entry in cache['entries'] if start < entry['revision'] <= end]
+
+def __fetch_log(client, trunk_url, start, end):
+    """Fetch the log of trunk from revision start up to end, oldest first.
+    """
+    __print_if_not_suppressed('\tFetching log of {0} from revision {1} to {2}'.format(trunk_url, start, end))
+    entries = client.log(trunk_url,
+                         revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, start),
+                         revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, end))
+    return [{'revision': entry['revision'].number,
+             'author': __get_log_value(entry, 'author', ''),
+             'date': __get_log_value(entry, 'date', 0),
+             'message': __get_log_value(entry, 'message', '')} for entry in entries]
+
+def __get_log_value(entry, key, default):
+    """Return an optional value of a log entry (e.g. the author is missing
+    for anonymous commits).
+    """
+    try:
+        value = entry[key]
+    except (KeyError, AttributeError):
+        return default
+    if value is None:
+        return default
+    return value
+
+def create_changelog(client, name, version, tag_type, root_url, trunk_url, tag_url):
+    """Create the changelog of a tag: the trunk log since the previous tag of
+    the same type (or since the start of trunk if there is none).
+    """
+    __print_if_not_suppressed('Creating changelog for {0}'.format(tag_url))
+    previous_tag_url = find_previous_tag(client, root_url, name, version, tag_type)
+    start = 0
+    if previous_tag_url is None:
+        __print_if_not_suppressed('\tNo previous {0} tag'.format(tag_type))
+    else:
+        __print_if_not_suppressed('\tPrevious tag is {0}'.format(previous_tag_url))
+        start = get_copy_revision(client, previous_tag_url, trunk_url) or 0
+    end = get_copy_revision(client, tag_url, trunk_url) or get_last_changed_revision(client, trunk_url)
+    lines = ['Changes in {0} {1} ({2}) since {3}'.format(name, version, tag_type, previous_tag_url or 'the start of trunk'), '']
+    for entry in reversed(get_trunk_log(client, trunk_url, start, end)):
+        lines.append('r{0} | {1} | {2}'.format(entry['revision'],
+                                                entry['author'],
+                                                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(entry['date']))))
+        lines.extend(entry['message'].strip().splitlines())
+        lines.append('')
+    return '\n'.join(lines)
+
+def attach_changelog(client, name, version, tag_url, changelog):
+    """Add a changelog to the root of a tag.
+    """
+    log_message = 'TeamCity adding changelog for {0}, version {1}'.format(name, version)
+    (handle, path) = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            f.write(changelog)
+        revision = client.import_(path, '{0}/{1}'.format(tag_url, CHANGELOG_NAME), log_message)
+    finally:
+        os.remove(path)
+    __print_if_not_suppressed('Changelog added at revision {0}'.format(revision.number))
@@ -17,8 +17,13 @@ import unittest
 import os
 import sys
 import shutil
+import tempfile
+import threading
+import time
 import pysvn
+import hostlock
 import svnerr
+import tagmetrics
 import tagutils
 import tagtrunk
 
@@ -139,9 +144,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'dev',
                                    'Trunk': 'C:\\Foo\\trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin\\Debug',
                                    'Build Source Full': 'C:\\Foo\\trunk\\bin\\Debug',
+                                   'Artifacts': [('C:\\Foo\\trunk\\bin\\Debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0-dev',
@@ -155,9 +162,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'dev',
                                    'Trunk': '/tmp/foo/trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin/debug',
                                    'Build Source Full': '/tmp/foo/trunk/bin/debug',
+                                   'Artifacts': [('/tmp/foo/trunk/bin/debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0-dev',
@@ -175,9 +184,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'dev',
                                    'Trunk': 'C:\\Foo\\trunk',
                                    'Source': '/',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin\\Debug',
                                    'Build Source Full': 'C:\\Foo\\trunk\\bin\\Debug',
+                                   'Artifacts': [('C:\\Foo\\trunk\\bin\\Debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0-dev',
@@ -191,9 +202,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'dev',
                                    'Trunk': '/tmp/foo/trunk',
                                    'Source': '/',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin/debug',
                                    'Build Source Full': '/tmp/foo/trunk/bin/debug',
+                                   'Artifacts': [('/tmp/foo/trunk/bin/debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0-dev',
@@ -202,6 +215,18 @@ class TestTagUtils(unittest.TestCase):
         param_dict = {}
         tagutils.assign_params(repo_info, args, param_dict)
         self.assertDictEqual(param_dict_expected, param_dict)
+        # Selection of trunk subpaths
+        args.S = 'src:lib,include\\'
+        param_dict = {}
+        tagutils.assign_params(repo_info, args, param_dict)
+        self.assertEqual(param_dict['Source'], '/src')
+        self.assertEqual(param_dict['Selection'], ['/lib', '/include'])
+        args.S = 'src'
+        # Additional artifacts
+        args.artifacts = ['pdb=symbols\\']
+        param_dict = {}
+        tagutils.assign_params(repo_info, args, param_dict)
+        self.assertEqual(param_dict['Artifacts'][1], (os.path.join(repo_info['trunk_dir'], 'pdb'), '/symbols'))
         # NOTE: PUT TESTS THAT SET THE ENVIRONMENT VARIABLE FROM HERE
         # Overwrite using environment variable for tagging type (dev -> rc1)
         os.environ[tagutils.EXECUTE_TAGGING_TYPE] = 'rc1'
@@ -213,9 +238,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'rc1',
                                    'Trunk': 'C:\\Foo\\trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin\\Debug',
                                    'Build Source Full': 'C:\\Foo\\trunk\\bin\\Debug',
+                                   'Artifacts': [('C:\\Foo\\trunk\\bin\\Debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0.0-rc1',
@@ -229,9 +256,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'rc1',
                                    'Trunk': '/tmp/foo/trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin/debug',
                                    'Build Source Full': '/tmp/foo/trunk/bin/debug',
+                                   'Artifacts': [('/tmp/foo/trunk/bin/debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0.0-rc1',
@@ -240,6 +269,13 @@ class TestTagUtils(unittest.TestCase):
         param_dict = {}
         tagutils.assign_params(repo_info, args, param_dict)
         self.assertDictEqual(param_dict_expected, param_dict)
+        # Sharded tags layout
+        os.environ[tagutils.TAG_LAYOUT] = tagutils.SHARDED_LAYOUT
+        param_dict = {}
+        tagutils.assign_params(repo_info, args, param_dict)
+        self.assertEqual(param_dict['Tag URL'], 'http://foo/tags/1/1.0/foo-1.0.0.0-rc1')
+        self.assertEqual(param_dict['Tag Build URL'], 'http://foo/tags/1/1.0/foo-1.0.0.0-rc1/build')
+        del os.environ[tagutils.TAG_LAYOUT]
         # Using empty environment variable for tagging type
         os.environ[tagutils.EXECUTE_TAGGING_TYPE] = ''
         if sys.platform == 'win32':
@@ -250,9 +286,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'final',
                                    'Trunk': 'C:\\Foo\\trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin\\Debug',
                                    'Build Source Full': 'C:\\Foo\\trunk\\bin\\Debug',
+                                   'Artifacts': [('C:\\Foo\\trunk\\bin\\Debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0.0-final',
@@ -266,9 +304,11 @@ class TestTagUtils(unittest.TestCase):
                                    'Tag Type': 'final',
                                    'Trunk': '/tmp/foo/trunk',
                                    'Source': '/src',
+                                   'Selection': [],
                                    'Build': '/build',
                                    'Build Source': 'bin/debug',
                                    'Build Source Full': '/tmp/foo/trunk/bin/debug',
+                                   'Artifacts': [('/tmp/foo/trunk/bin/debug', '/build')],
                                    'Root URL': 'http://foo',
                                    'Trunk URL': 'http://foo/trunk',
                                    'Tag URL': 'http://foo/tags/foo-1.0.0.0-final',
@@ -308,6 +348,33 @@ class TestTagUtils(unittest.TestCase):
                                              'http://qux/trunk',
                                              'http://qux/tags/qux-1.0.0.0-final',
                                              'http://qux/tags/qux-1.0.0.0-final/src'))
+        # Selection of subpaths
+        self.assertTrue(tagutils.create_tag(client,
+                                            'foo',
+                                            '1.0.0.0',
+                                            'http://foo/trunk',
+                                            'http://foo/tags/foo-1.0.0.0-final',
+                                            'http://foo/tags/foo-1.0.0.0-final/src',
+                                            ['/lib', '/include']))
+        self.assertFalse(tagutils.create_tag(client,
+                                             'bar',
+                                             '1.0.0.0',
+                                             'http://bar/trunk',
+                                             'http://bar/tags/bar-1.0.0.0-final',
+                                             'http://bar/tags/bar-1.0.0.0-final/src',
+                                             ['/lib']))
+        # The tag created for the copy is removed again
+        self.assertEqual(client.removed, ['http://bar/tags/bar-1.0.0.0-final'])
+        client.removed = []
+        # A failed copy into a tag created up front removes the tag again
+        self.assertFalse(tagutils.create_tag(client,
+                                             'foo',
+                                             '1.0.0.0',
+                                             'http://foo/trunk',
+                                             'http://foo/tags/foo-1.0.0.0-final',
+                                             'http://foo/tags/foo-1.0.0.0-final',
+                                             ['/docs', '/lib/bar/core']))
+        self.assertEqual(client.removed, ['http://foo/tags/foo-1.0.0.0-final'])
         # Unexpected
         with self.assertRaises(pysvn.ClientError):
             tagutils.create_tag(client,
@@ -317,6 +384,26 @@ class TestTagUtils(unittest.TestCase):
                                 'http://baz/tags/baz-1.0.0.0-final',
                                 'http://baz/tags/baz-1.0.0.0-final/src')
 
+    def test_get_selection_operations(self):
+        # Top-level subpaths are copied in one commit
+        (mkdir_urls, copies) = tagutils.get_selection_operations('http://foo/trunk',
+                                                                 'http://foo/tags/foo-1.0.0.0-final',
+                                                                 'http://foo/tags/foo-1.0.0.0-final/src',
+                                                                 ['/lib', '/include'])
+        self.assertEqual(mkdir_urls, ['http://foo/tags/foo-1.0.0.0-final', 'http://foo/tags/foo-1.0.0.0-final/src'])
+        self.assertEqual(copies, [(['http://foo/trunk/lib', 'http://foo/trunk/include'], 'http://foo/tags/foo-1.0.0.0-final/src')])
+        # Nested subpaths need their parents and are grouped by parent
+        (mkdir_urls, copies) = tagutils.get_selection_operations('http://foo/trunk',
+                                                                 'http://foo/tags/foo-1.0.0.0-final',
+                                                                 'http://foo/tags/foo-1.0.0.0-final',
+                                                                 ['/lib/core', '/docs', '/lib/net/http'])
+        self.assertEqual(mkdir_urls, ['http://foo/tags/foo-1.0.0.0-final',
+                                      'http://foo/tags/foo-1.0.0.0-final/lib',
+                                      'http://foo/tags/foo-1.0.0.0-final/lib/net'])
+        self.assertEqual(copies, [(['http://foo/trunk/lib/core'], 'http://foo/tags/foo-1.0.0.0-final/lib'),
+                                  (['http://foo/trunk/docs'], 'http://foo/tags/foo-1.0.0.0-final'),
+                                  (['http://foo/trunk/lib/net/http'], 'http://foo/tags/foo-1.0.0.0-final/lib/net')])
+
     def test_import_artifacts(self):
         client = MockPySvn('', '')
         # No such path
@@ -327,6 +414,143 @@ class TestTagUtils(unittest.TestCase):
         self.assertTrue(tagutils.import_artifacts(client, 'foo', '1.0.0.0', buildDir, 'http://foo/tags/foo-1.0.0.0-final/build'))
         os.rmdir(buildDir)
 
+    def test_import_artifact_roots(self):
+        client = MockPySvn('', '')
+        buildDir = './test/trunk/build'
+        artifacts = [('{0}/bin'.format(buildDir), '/build'),
+                     ('{0}/pdb'.format(buildDir), '/symbols/x86'),
+                     ('./test/trunk/source.txt', '/docs/source.txt')]
+        # Missing build sources
+        self.assertFalse(tagutils.import_artifact_roots(client, 'foo', '1.0.0.0', artifacts, 'http://foo/tags/foo-1.0.0.0-final', './test/trunk'))
+        self.assertEqual(client.imported, [])
+        # All trees are staged and imported at once
+        os.makedirs('{0}/bin/sub'.format(buildDir))
+        os.makedirs('{0}/pdb'.format(buildDir))
+        for name in ['bin/a.dll', 'bin/sub/b.dll', 'pdb/a.pdb']:
+            f = open('{0}/{1}'.format(buildDir, name), 'w')
+            f.close()
+        self.assertTrue(tagutils.import_artifact_roots(client, 'foo', '1.0.0.0', artifacts, 'http://foo/tags/foo-1.0.0.0-final', './test/trunk'))
+        self.assertEqual(len(client.imported), 1)
+        self.assertEqual(client.imported[0][1], 'http://foo/tags/foo-1.0.0.0-final')
+        self.assertEqual(sorted(client.imported[0][2]),
+                         sorted([os.path.join('build', 'a.dll'),
+                                 os.path.join('build', 'sub', 'b.dll'),
+                                 os.path.join('docs', 'source.txt'),
+                                 os.path.join('symbols', 'x86', 'a.pdb')]))
+        # Staging directory is cleaned up
+        self.assertEqual(sorted(os.listdir('./test/trunk')), ['build', 'source.txt'])
+        # Default BS: trunk itself is a build source, even with the staging
+        # directory inside it, and administrative directories aren't staged
+        os.makedirs('./test/trunk/{0}'.format(tagutils.SVN_ADMIN_DIR))
+        f = open('./test/trunk/{0}/wc.db'.format(tagutils.SVN_ADMIN_DIR), 'w')
+        f.close()
+        client = MockPySvn('', '')
+        artifacts = [('./test/trunk/', '/build'), ('{0}/pdb'.format(buildDir), '/symbols')]
+        self.assertTrue(tagutils.import_artifact_roots(client, 'foo', '1.0.0.0', artifacts, 'http://foo/tags/foo-1.0.0.0-final', './test/trunk'))
+        self.assertEqual(sorted(client.imported[0][2]),
+                         sorted([os.path.join('build', 'source.txt'),
+                                 os.path.join('build', 'build', 'bin', 'a.dll'),
+                                 os.path.join('build', 'build', 'bin', 'sub', 'b.dll'),
+                                 os.path.join('build', 'build', 'pdb', 'a.pdb'),
+                                 os.path.join('symbols', 'a.pdb')]))
+        shutil.rmtree('./test/trunk/{0}'.format(tagutils.SVN_ADMIN_DIR))
+        shutil.rmtree(buildDir)
+
+    def test_verify_artifacts(self):
+        client = MockPySvn('', '')
+        buildDir = './test/trunk/build'
+        os.makedirs('{0}/sub'.format(buildDir))
+        for (name, size) in [('a.dll', 3), ('sub/b.dll', 5), ('done', 0)]:
+            f = open('{0}/{1}'.format(buildDir, name), 'w')
+            f.write('x' * size)
+            f.close()
+        tagUrl = 'http://foo/tags/foo-1.0.0.0-final'
+        artifacts = [(buildDir, '/build'), ('./test/trunk/source.txt', '/docs/source.txt')]
+        client.listing = {'{0}/build'.format(tagUrl): [('a.dll', 3), ('sub/b.dll', 5)],
+                          '{0}/docs/source.txt'.format(tagUrl): [('', os.path.getsize('./test/trunk/source.txt'))]}
+        # Matches, leaving out the marker
+        self.assertEqual(tagutils.verify_artifacts(client, artifacts, tagUrl, '{0}/done'.format(buildDir)), [])
+        # Marker isn't in the tag
+        self.assertEqual(len(tagutils.verify_artifacts(client, artifacts, tagUrl)), 1)
+        # Wrong size, missing and unexpected files
+        client.listing['{0}/build'.format(tagUrl)] = [('a.dll', 4), ('c.dll', 1)]
+        self.assertEqual(tagutils.verify_artifacts(client, artifacts, tagUrl, '{0}/done'.format(buildDir)),
+                         ['{0}/build/a.dll is 4 bytes instead of 3'.format(tagUrl),
+                          '{0}/build/c.dll doesn\'t exist in {1}'.format(tagUrl, buildDir),
+                          '{0}/build/sub/b.dll is missing'.format(tagUrl)])
+        # Nothing in the tag
+        del client.listing['{0}/docs/source.txt'.format(tagUrl)]
+        self.assertEqual(tagutils.verify_artifacts(client, artifacts[1:], tagUrl),
+                         ['{0}/docs/source.txt is missing'.format(tagUrl)])
+        shutil.rmtree(buildDir)
+        # Default BS: the trunk working copy, whose administrative directory isn't imported
+        os.makedirs('./test/trunk/{0}'.format(tagutils.SVN_ADMIN_DIR))
+        f = open('./test/trunk/{0}/wc.db'.format(tagutils.SVN_ADMIN_DIR), 'w')
+        f.write('x')
+        f.close()
+        client.listing = {'{0}/build'.format(tagUrl): [('source.txt', os.path.getsize('./test/trunk/source.txt'))]}
+        self.assertEqual(tagutils.verify_artifacts(client, [('./test/trunk', '/build')], tagUrl), [])
+        shutil.rmtree('./test/trunk/{0}'.format(tagutils.SVN_ADMIN_DIR))
+
+    def test_watch_artifacts(self):
+        client = MockPySvn('', '')
+        buildDir = './test/trunk/build'
+        marker = '{0}/done'.format(buildDir)
+        interval = tagutils.WATCH_INTERVAL
+        tagutils.WATCH_INTERVAL = 0
+        # Build never produced its output
+        f = open('./test/trunk/done', 'w')
+        f.close()
+        self.assertFalse(tagutils.watch_artifacts(client, 'foo', '1.0.0.0', buildDir, 'http://foo/tags/foo-1.0.0.0-final/build', './test/trunk/done'))
+        os.remove('./test/trunk/done')
+        # Completed build: everything but the marker is committed at once
+        os.makedirs('{0}/bin'.format(buildDir))
+        for name in ['a.dll', 'bin/b.dll', 'done']:
+            f = open('{0}/{1}'.format(buildDir, name), 'w')
+            f.close()
+        self.assertTrue(tagutils.watch_artifacts(client, 'foo', '1.0.0.0', buildDir, 'http://foo/tags/foo-1.0.0.0-final/build', marker))
+        self.assertEqual(sorted([os.path.basename(path) for path in client.added]), ['a.dll', 'b.dll'])
+        self.assertEqual(client.checkins, 1)
+        shutil.rmtree(buildDir)
+        # Files removed by the build before it completes are removed from the tag
+        os.makedirs(buildDir)
+        f = open('{0}/tmp.obj'.format(buildDir), 'w')
+        f.close()
+        polls = []
+        def build(seconds):
+            # tmp.obj is stable (and committed) after the second poll
+            polls.append(seconds)
+            if len(polls) == 2:
+                os.remove('{0}/tmp.obj'.format(buildDir))
+                open(marker, 'w').close()
+        sleep = tagutils.time.sleep
+        tagutils.time.sleep = build
+        try:
+            self.assertTrue(tagutils.watch_artifacts(client, 'foo', '1.0.0.0', buildDir, 'http://foo/tags/foo-1.0.0.0-final/build', marker))
+        finally:
+            tagutils.time.sleep = sleep
+            tagutils.WATCH_INTERVAL = interval
+        self.assertEqual([os.path.basename(path) for path in client.removed], ['tmp.obj'])
+        self.assertEqual(client.checkins, 3)
+        self.assertEqual(len(polls), 2)
+        shutil.rmtree(buildDir)
+        # Touched but unchanged files leave nothing to commit
+        os.makedirs(buildDir)
+        for name in ['a.dll', 'done']:
+            f = open('{0}/{1}'.format(buildDir, name), 'w')
+            f.close()
+        client.nothing_to_commit = True
+        self.assertTrue(tagutils.watch_artifacts(client, 'foo', '1.0.0.0', buildDir, 'http://foo/tags/foo-1.0.0.0-final/build', marker))
+        self.assertEqual(client.checkins, 4)
+        shutil.rmtree(buildDir)
+
+    def test_remove_incomplete_tag(self):
+        client = MockPySvn('', '')
+        self.assertTrue(tagutils.remove_incomplete_tag(client, 'http://foo/tags/foo-1.0.0.0-final'))
+        self.assertEqual(client.removed, ['http://foo/tags/foo-1.0.0.0-final'])
+        # Errors are reported, not raised
+        self.assertFalse(tagutils.remove_incomplete_tag(client, 'http://baz/tags/baz-1.0.0.0-final'))
+
     def test_remove_dev_tag(self):
         client = MockPySvn('', '')
         # Normal execution where tag exists
@@ -337,11 +561,525 @@ class TestTagUtils(unittest.TestCase):
         with self.assertRaises(pysvn.ClientError):
             tagutils.remove_dev_tag(client, 'http://baz/tags/baz-1.0.0-dev')
 
+    def test_path_exists(self):
+        client = MockPySvn('', '')
+        # Exists
+        self.assertTrue(tagutils.path_exists(client, 'http://qux/tags/qux-1.0.0.0-final'))
+        # Doesn't exist
+        self.assertFalse(tagutils.path_exists(client, 'http://missing/tags/missing-1.0.0.0-final'))
+        # Unexpected
+        with self.assertRaises(pysvn.ClientError):
+            tagutils.path_exists(client, 'http://foo/tags/foo-1.0.0.0-final')
+
+    def test_scan_artifacts(self):
+        # No such path
+        self.assertEqual(tagutils.scan_artifacts('./test/trunk/build'), (0, 0))
+        # Single file
+        self.assertEqual(tagutils.scan_artifacts('./test/trunk/source.txt'),
+                         (1, os.path.getsize('./test/trunk/source.txt')))
+        # Nested tree
+        buildDir = './test/trunk/build'
+        os.makedirs('{0}/bin/x86'.format(buildDir))
+        for (name, size) in [('a.dll', 3), ('bin/b.dll', 5), ('bin/x86/c.dll', 7)]:
+            f = open('{0}/{1}'.format(buildDir, name), 'w')
+            f.write('x' * size)
+            f.close()
+        self.assertEqual(tagutils.scan_artifacts(buildDir), (3, 15))
+        # Administrative directories (e.g. with the default BS) aren't imported
+        for adminDir in ['{0}/{1}'.format(buildDir, tagutils.SVN_ADMIN_DIR), '{0}/bin/{1}'.format(buildDir, tagutils.SVN_ADMIN_DIR)]:
+            os.makedirs(adminDir)
+            f = open('{0}/wc.db'.format(adminDir), 'w')
+            f.write('x' * 1000)
+            f.close()
+        self.assertEqual(tagutils.scan_artifacts(buildDir), (3, 15))
+        shutil.rmtree(buildDir)
+
+    def test_plan_tagging(self):
+        client = MockPySvn('', '')
+        param_dict = {'Name': 'missing',
+                      'Version': '1.0.0',
+                      'Tag Type': 'dev',
+                      'Build Source Full': './test/trunk/source.txt',
+                      'Artifacts': [('./test/trunk/source.txt', '/build')],
+                      'Selection': [],
+                      'Trunk URL': 'http://missing/trunk',
+                      'Tag URL': 'http://missing/tags/missing-1.0.0-dev',
+                      'Tag Source URL': 'http://missing/tags/missing-1.0.0-dev/src',
+                      'Tag Build URL': 'http://missing/tags/missing-1.0.0-dev/build'}
+        # New dev tag: mkdir, copy and import
+        plan = tagutils.plan_tagging(client, param_dict)
+        self.assertFalse(plan['tag_exists'])
+        self.assertEqual([op['operation'] for op in plan['operations']], ['mkdir', 'copy', 'import'])
+        self.assertEqual(plan['commits'], 3)
+        self.assertEqual(plan['artifact_files'], 1)
+        # Existing dev tag gets removed first; no artifacts to import
+        param_dict['Tag URL'] = 'http://qux/tags/qux-1.0.0-dev'
+        param_dict['Tag Source URL'] = param_dict['Tag URL']
+        param_dict['Build Source Full'] = './test/trunk/build'
+        param_dict['Artifacts'] = [('./test/trunk/build', '/build')]
+        plan = tagutils.plan_tagging(client, param_dict)
+        self.assertTrue(plan['tag_exists'])
+        self.assertEqual([op['operation'] for op in plan['operations']], ['remove', 'copy'])
+        self.assertEqual(plan['artifact_bytes'], 0)
+        # Only selected trunk subpaths are copied
+        param_dict['Selection'] = ['/lib', '/include']
+        plan = tagutils.plan_tagging(client, param_dict)
+        self.assertEqual([op['operation'] for op in plan['operations']], ['remove', 'mkdir', 'copy'])
+        self.assertEqual(plan['operations'][2]['from'], ['http://missing/trunk/lib', 'http://missing/trunk/include'])
+        param_dict['Selection'] = []
+        # Several build sources are imported in a single commit
+        param_dict['Artifacts'] = [('./test/trunk/build', '/build'), ('./test/trunk/source.txt', '/docs/source.txt')]
+        plan = tagutils.plan_tagging(client, param_dict)
+        self.assertEqual(plan['operations'][-1]['to'], param_dict['Tag URL'])
+        self.assertEqual(plan['commits'], 3)
+        self.assertEqual(plan['artifact_files'], 1)
+        self.assertFalse(plan['estimate'])
+        # The changelog is another commit
+        param_dict['Artifacts'] = [('./test/trunk/build', '/build')]
+        plan = tagutils.plan_tagging(client, param_dict, True)
+        self.assertEqual([op['operation'] for op in plan['operations']], ['remove', 'copy', 'import'])
+        self.assertEqual(plan['operations'][-1]['to'], 'http://qux/tags/qux-1.0.0-dev/{0}'.format(tagutils.CHANGELOG_NAME))
+        # Watching the build that hasn't started yet takes at least two commits
+        plan = tagutils.plan_tagging(client, param_dict, False, './test/trunk/build/done')
+        self.assertEqual([op['operation'] for op in plan['operations']], ['remove', 'copy', 'mkdir', 'watch'])
+        self.assertEqual(plan['commits'], 4)
+        self.assertTrue(plan['estimate'])
+
+    def test_preflight_checks(self):
+        client = MockPySvn('', '')
+        param_dict = {'Tag Type': 'final',
+                      'Artifacts': [('./test/trunk/source.txt', '/build')],
+                      'Selection': ['/lib'],
+                      'Root URL': 'http://qux',
+                      'Trunk URL': 'http://qux/trunk',
+                      'Tag URL': 'http://qux/tags/missing-1.0.0.0-final'}
+        # Everything in place
+        self.assertEqual(tagutils.preflight_checks(client, param_dict), (True, ''))
+        self.assertEqual(param_dict['Artifact Bytes'], os.path.getsize('./test/trunk/source.txt'))
+        # Final tag exists
+        param_dict['Tag URL'] = 'http://qux/tags/qux-1.0.0.0-final'
+        self.assertFalse(tagutils.preflight_checks(client, param_dict)[0])
+        # Existing dev tag gets replaced
+        param_dict['Tag Type'] = 'dev'
+        self.assertTrue(tagutils.preflight_checks(client, param_dict)[0])
+        # Selected subpath doesn't exist
+        param_dict['Selection'] = ['/lib', '/missing']
+        self.assertEqual(tagutils.preflight_checks(client, param_dict), (False, 'Selected trunk subpath /missing doesn\'t exist'))
+        # All failures are reported together
+        param_dict = {'Tag Type': 'final',
+                      'Artifacts': [('./test/trunk/build', '/build')],
+                      'Selection': [],
+                      'Root URL': 'http://missing',
+                      'Trunk URL': 'http://missing/trunk',
+                      'Tag URL': 'http://missing/tags/missing-1.0.0.0-final'}
+        (valid, errorMessage) = tagutils.preflight_checks(client, param_dict)
+        self.assertFalse(valid)
+        self.assertEqual(len(errorMessage.split('; ')), 3)
+        # Build source isn't required when watching the build
+        (valid, errorMessage) = tagutils.preflight_checks(client, param_dict, False)
+        self.assertEqual(len(errorMessage.split('; ')), 2)
+        # A marker left over from a previous build would make it look complete
+        (valid, errorMessage) = tagutils.preflight_checks(client, param_dict, False, './test/trunk/source.txt')
+        self.assertEqual(len(errorMessage.split('; ')), 3)
+        self.assertTrue(errorMessage.endswith('Build completion marker ./test/trunk/source.txt already exists'))
+
+    def test_escape_teamcity_value(self):
+        self.assertEqual(tagutils.escape_teamcity_value('Tag doesn\'t exist'), 'Tag doesn|\'t exist')
+        self.assertEqual(tagutils.escape_teamcity_value('[a|b]\nc\r'), '|[a||b|]|nc|r')
+
+    def test_get_throttle_settings(self):
+        lockDir = tempfile.mkdtemp()
+        config = os.path.join(lockDir, 'throttle.cfg')
+        f = open(config, 'w')
+        f.write('[DEFAULT]\nmax_concurrent_imports = 4\n')
+        f.write('[http://foo]\nbytes_per_second = 100\n')
+        f.write('[http://foobar]\nmax_concurrent_imports = 1\nburst_bytes = 500\n')
+        f.close()
+        # Not configured
+        if hostlock.THROTTLE_CONFIG in os.environ:
+            del os.environ[hostlock.THROTTLE_CONFIG]
+        self.assertIsNone(hostlock.get_throttle_settings('http://foo/trunk'))
+        os.environ[hostlock.THROTTLE_CONFIG] = config
+        # Defaults only
+        self.assertEqual(hostlock.get_throttle_settings('http://qux/trunk'),
+                         {'max_concurrent_imports': 4, 'bytes_per_second': 0, 'burst_bytes': 0})
+        # Server section; burst defaults to the rate
+        self.assertEqual(hostlock.get_throttle_settings('http://foo/trunk'),
+                         {'max_concurrent_imports': 4, 'bytes_per_second': 100, 'burst_bytes': 100})
+        # Sections match the server only, not any URL with the same prefix
+        self.assertEqual(hostlock.get_throttle_settings('http://foobar/trunk'),
+                         {'max_concurrent_imports': 1, 'bytes_per_second': 0, 'burst_bytes': 500})
+        self.assertEqual(hostlock.get_throttle_settings('http://foo/bar/trunk'),
+                         {'max_concurrent_imports': 4, 'bytes_per_second': 100, 'burst_bytes': 100})
+        # Malformed values and files
+        f = open(config, 'a')
+        f.write('[http://baz]\nbytes_per_second = 10MB\n')
+        f.close()
+        with self.assertRaises(ValueError):
+            hostlock.get_throttle_settings('http://baz/trunk')
+        f = open(config, 'w')
+        f.write('bytes_per_second = 100\n')
+        f.close()
+        with self.assertRaises(ValueError):
+            hostlock.get_throttle_settings('http://foo/trunk')
+        # Reported by the preflight checks, before anything is written
+        param_dict = {'Tag Type': 'final',
+                      'Artifacts': [('./test/trunk/source.txt', '/build')],
+                      'Selection': [],
+                      'Root URL': 'http://qux',
+                      'Trunk URL': 'http://qux/trunk',
+                      'Tag URL': 'http://qux/tags/missing-1.0.0.0-final'}
+        (valid, errorMessage) = tagutils.preflight_checks(MockPySvn('', ''), param_dict)
+        self.assertFalse(valid)
+        self.assertTrue(errorMessage.startswith('Invalid throttling configuration'))
+        del os.environ[hostlock.THROTTLE_CONFIG]
+        self.assertEqual(tagutils.preflight_checks(MockPySvn('', ''), param_dict), (True, ''))
+        self.assertIsNone(param_dict['Throttle'])
+        shutil.rmtree(lockDir)
+
+    def test_acquire_slot(self):
+        os.environ[hostlock.LOCK_DIR] = tempfile.mkdtemp()
+        # Unlimited
+        self.assertIsNone(hostlock.acquire_slot('http://foo/trunk', 0))
+        # Two slots can be taken, the third would wait
+        slot1 = hostlock.acquire_slot('http://foo/trunk', 2)
+        slot2 = hostlock.acquire_slot('http://foo/tags', 2)
+        self.assertNotEqual(slot1.name, slot2.name)
+        f = open(slot1.name, 'a+')
+        self.assertFalse(hostlock.try_lock_file(f))
+        f.close()
+        hostlock.release_slot(slot1)
+        slot3 = hostlock.acquire_slot('http://foo/trunk', 2)
+        self.assertEqual(slot1.name, slot3.name)
+        hostlock.release_slot(slot2)
+        hostlock.release_slot(slot3)
+        shutil.rmtree(os.environ[hostlock.LOCK_DIR])
+        del os.environ[hostlock.LOCK_DIR]
+
+    def test_consume_bandwidth(self):
+        os.environ[hostlock.LOCK_DIR] = tempfile.mkdtemp()
+        # Unlimited
+        self.assertEqual(hostlock.consume_bandwidth('http://foo/trunk', 1000, 0, 0), 0.0)
+        # Within the burst
+        self.assertEqual(hostlock.consume_bandwidth('http://foo/trunk', 300, 100, 500, now=0.0), 0.0)
+        # Into debt: 200 left, 400 taken, 200 short at 100 bytes/s
+        self.assertAlmostEqual(hostlock.consume_bandwidth('http://foo/trunk', 400, 100, 500, now=0.0), 2.0)
+        # Refilled after 3s, so 100 in credit
+        self.assertEqual(hostlock.consume_bandwidth('http://foo/trunk', 100, 100, 500, now=3.0), 0.0)
+        # Other servers have their own bucket
+        self.assertEqual(hostlock.consume_bandwidth('http://bar/trunk', 500, 100, 500, now=3.0), 0.0)
+        shutil.rmtree(os.environ[hostlock.LOCK_DIR])
+        del os.environ[hostlock.LOCK_DIR]
+
+    def test_acquire_lease(self):
+        os.environ[hostlock.LOCK_DIR] = tempfile.mkdtemp()
+        tagUrl = 'http://foo/tags/foo-1.0.0-dev'
+        # Uncontended
+        lease = hostlock.acquire_lease(tagUrl)
+        self.assertIsNotNone(lease)
+        leaseDir = os.path.dirname(lease[2])
+        hostlock.release_lease(lease)
+        self.assertEqual([n for n in os.listdir(leaseDir) if n.endswith(hostlock.TICKET_SUFFIX)], [])
+        # A stale newer ticket (its process died) is removed
+        stale = os.path.join(leaseDir, '9999999999999.000000-1{0}'.format(hostlock.TICKET_SUFFIX))
+        open(stale, 'w').close()
+        lease = hostlock.acquire_lease(tagUrl)
+        self.assertIsNotNone(lease)
+        self.assertFalse(os.path.exists(stale))
+        hostlock.release_lease(lease)
+        # A live newer ticket supersedes this process
+        f = open(stale, 'a+')
+        hostlock.lock_file(f)
+        self.assertIsNone(tagutils.acquire_dev_tag_lease(tagUrl))
+        hostlock.unlock_file(f)
+        f.close()
+        # An older waiter gives up once a newer process got the lease before it
+        os.remove(stale)
+        leaseA = hostlock.acquire_lease(tagUrl)
+        leaseB = []
+        interval = hostlock.POLL_INTERVAL
+        hostlock.POLL_INTERVAL = 1
+        try:
+            waiter = threading.Thread(target=lambda: leaseB.append(hostlock.acquire_lease(tagUrl)))
+            waiter.start()
+            while len([n for n in os.listdir(leaseDir) if n.endswith(hostlock.TICKET_SUFFIX)]) < 2:
+                time.sleep(0.01)
+            hostlock.release_lease(leaseA)
+            leaseC = hostlock.acquire_lease(tagUrl)
+            self.assertIsNotNone(leaseC)
+            hostlock.release_lease(leaseC)
+            waiter.join()
+        finally:
+            hostlock.POLL_INTERVAL = interval
+        self.assertEqual(leaseB, [None])
+        # Other tags are independent
+        lease = tagutils.acquire_dev_tag_lease('http://bar/tags/bar-1.0.0-dev')
+        self.assertIsNotNone(lease)
+        hostlock.release_lease(lease)
+        shutil.rmtree(os.environ[hostlock.LOCK_DIR])
+        del os.environ[hostlock.LOCK_DIR]
+
+    def test_validate_compare_args(self):
+        self.assertTrue(tagutils.validate_compare_args(MockCompareArgs('1.2.0.0-final', '1.2.1.0-rc1', 'src'))[0])
+        self.assertTrue(tagutils.validate_compare_args(MockCompareArgs('1.2.0-dev', '1.2.1.0-final', 'src'))[0])
+        self.assertFalse(tagutils.validate_compare_args(MockCompareArgs('1.2.0-final', '1.2.1.0-final', 'src'))[0])
+        self.assertFalse(tagutils.validate_compare_args(MockCompareArgs('1.2.0.0-final', '1.2.1.0', 'src'))[0])
+
+    def test_assign_compare_params(self):
+        param_dict = {}
+        tagutils.assign_compare_params({'trunk_url': 'http://foo/trunk'},
+                                       MockCompareArgs('1.2.0.0-final', '1.2.1-dev', 'src:lib', 'bin\\'),
+                                       param_dict)
+        self.assertDictEqual(param_dict, {'Name': 'foo',
+                                          'Source': '/src',
+                                          'Build': '/bin',
+                                          'Root URL': 'http://foo',
+                                          'From Tag URL': 'http://foo/tags/foo-1.2.0.0-final',
+                                          'To Tag URL': 'http://foo/tags/foo-1.2.1-dev'})
+
+    def test_compare_tags(self):
+        os.environ[tagutils.CACHE_DIR] = tempfile.mkdtemp()
+        client = MockPySvn('', '')
+        fromUrl = 'http://qux/tags/qux-1.2.0.0-final'
+        toUrl = 'http://qux/tags/qux-1.2.1.0-final'
+        client.listing = {'{0}/build'.format(fromUrl): [('a.dll', 3), ('b.dll', 5)],
+                          '{0}/build'.format(toUrl): [('a.dll', 4), ('c.dll', 1)]}
+        client.summary = [('main.c', pysvn.diff_summarize_kind.modified, False),
+                          ('README', pysvn.diff_summarize_kind.normal, False),
+                          ('lib', pysvn.diff_summarize_kind.normal, True),
+                          ('new.c', pysvn.diff_summarize_kind.added, False)]
+        report = tagutils.compare_tags(client, fromUrl, toUrl, '/src', '/build')
+        self.assertEqual([change['path'] for change in report['source']], ['lib', 'main.c', 'new.c'])
+        self.assertEqual(report['build'], [{'path': 'a.dll', 'change': 'modified'},
+                                           {'path': 'b.dll', 'change': 'deleted'},
+                                           {'path': 'c.dll', 'change': 'added'}])
+        self.assertEqual(client.diffs, 1)
+        # Repeated comparison comes from the cache
+        self.assertEqual(tagutils.compare_tags(client, fromUrl, toUrl, '/src', '/build'), report)
+        self.assertEqual(client.diffs, 1)
+        shutil.rmtree(os.environ[tagutils.CACHE_DIR])
+        del os.environ[tagutils.CACHE_DIR]
+
+    def test_find_previous_tag(self):
+        client = MockPySvn('', '')
+        client.listing = {'http://qux/tags': [('qux-1.0.0.0-final', 0),
+                                              ('qux-1.1.0.0-final', 0),
+                                              ('qux-1.1.0.0-rc1', 0),
+                                              ('qux-1.10.0.0-final', 0),
+                                              ('qux-1.2.0-dev', 0),
+                                              ('quxx-1.1.5.0-final', 0),
+                                              ('qux-junk-final', 0)]}
+        # Versions are compared numerically, not as text
+        self.assertEqual(tagutils.find_previous_tag(client, 'http://qux', 'qux', '1.2.0.0', 'final'), 'http://qux/tags/qux-1.1.0.0-final')
+        self.assertEqual(tagutils.find_previous_tag(client, 'http://qux', 'qux', '1.11.0.0', 'final'), 'http://qux/tags/qux-1.10.0.0-final')
+        self.assertEqual(tagutils.find_previous_tag(client, 'http://qux', 'qux', '1.2.0.0', 'rc1'), 'http://qux/tags/qux-1.1.0.0-rc1')
+        # No previous tag of this type
+        self.assertIsNone(tagutils.find_previous_tag(client, 'http://qux', 'qux', '1.0.0.0', 'final'))
+        self.assertIsNone(tagutils.find_previous_tag(client, 'http://qux', 'qux', '1.2.0', 'dev'))
+
+    def test_get_copy_revision(self):
+        client = MockPySvn('', '')
+        client.logs = {'http://qux/tags/qux-1.1.0.0-final': [(12, 'import', []), (11, 'copy', [('/trunk', 10)]), (10, 'mkdir', [])]}
+        self.assertEqual(tagutils.get_copy_revision(client, 'http://qux/tags/qux-1.1.0.0-final', 'http://qux/trunk'), 10)
+        self.assertIsNone(tagutils.get_copy_revision(client, 'http://qux/tags/qux-1.2.0.0-final', 'http://qux/trunk'))
+        # Selected subpaths are copied from below trunk
+        client.logs['http://qux/tags/qux-1.3.0.0-final'] = [(14, 'copy', [('/trunk/lib', 13), ('/trunk/include', 13)])]
+        self.assertEqual(tagutils.get_copy_revision(client, 'http://qux/tags/qux-1.3.0.0-final', 'http://qux/trunk'), 13)
+        # History is followed across a move, e.g. into a shard
+        client.logs['http://qux/tags/1/1.1/qux-1.1.0.0-final'] = [(20, 'move', [('/tags/qux-1.1.0.0-final', 19, '/tags/1/1.1/qux-1.1.0.0-final')])]
+        self.assertEqual(tagutils.get_copy_revision(client, 'http://qux/tags/1/1.1/qux-1.1.0.0-final', 'http://qux/trunk'), 10)
+        # Copies from elsewhere aren't trunk revisions
+        client.logs['http://qux/tags/qux-1.4.0.0-final'] = [(22, 'copy', [('/branches/foo', 21)])]
+        self.assertIsNone(tagutils.get_copy_revision(client, 'http://qux/tags/qux-1.4.0.0-final', 'http://qux/trunk'))
+
+    def test_create_changelog(self):
+        os.environ[tagutils.CACHE_DIR] = tempfile.mkdtemp()
+        client = MockPySvn('', '')
+        client.listing = {'http://qux/tags': [('qux-1.0.0.0-final', 0)]}
+        client.logs = {'http://qux/tags/qux-1.0.0.0-final': [(3, 'copy', [('/trunk', 2)])],
+                       'http://qux/tags/qux-1.1.0.0-final': [(7, 'copy', [('/trunk', 6)])],
+                       'http://qux/trunk': [(r, 'Change {0}'.format(r), []) for r in range(1, 10)]}
+        changelog = tagutils.create_changelog(client, 'qux', '1.1.0.0', 'final', 'http://qux', 'http://qux/trunk', 'http://qux/tags/qux-1.1.0.0-final')
+        self.assertEqual([line for line in changelog.splitlines() if line.startswith('Change ')],
+                         ['Change 6', 'Change 5', 'Change 4', 'Change 3'])
+        self.assertEqual(client.log_fetches, [(3, 6)])
+        # Cache is only extended with what it doesn't cover yet
+        self.assertEqual([entry['revision'] for entry in tagutils.get_trunk_log(client, 'http://qux/trunk', 4, 8)], [5, 6, 7, 8])
+        self.assertEqual([entry['revision'] for entry in tagutils.get_trunk_log(client, 'http://qux/trunk', 0, 2)], [1, 2])
+        self.assertEqual([entry['revision'] for entry in tagutils.get_trunk_log(client, 'http://qux/trunk', 1, 8)], list(range(2, 9)))
+        self.assertEqual(client.log_fetches, [(3, 6), (7, 8), (1, 2)])
+        # Changelog gets added to the tag
+        tagutils.attach_changelog(client, 'qux', '1.1.0.0', 'http://qux/tags/qux-1.1.0.0-final', changelog)
+        self.assertEqual(client.imported[-1][1], 'http://qux/tags/qux-1.1.0.0-final/{0}'.format(tagutils.CHANGELOG_NAME))
+        shutil.rmtree(os.environ[tagutils.CACHE_DIR])
+        del os.environ[tagutils.CACHE_DIR]
+
+    def test_get_tag_url(self):
+        self.assertEqual(tagutils.get_shard_path('1.2.3.4'), '1/1.2')
+        self.assertEqual(tagutils.get_shard_path('10.0.1'), '10/10.0')
+        self.assertEqual(tagutils.get_tag_url('http://foo', 'foo', '1.2.3.4', 'final'), 'http://foo/tags/foo-1.2.3.4-final')
+        self.assertEqual(tagutils.get_tag_url('http://foo', 'foo', '1.2.3', 'dev', True), 'http://foo/tags/1/1.2/foo-1.2.3-dev')
+
+    def test_create_shard(self):
+        client = MockPySvn('', '')
+        # Shard exists
+        tagutils.create_shard(client, 'http://bar/tags/1/1.2/bar-1.2.0.0-final')
+        self.assertEqual(client.mkdirs, [])
+        # New shard
+        tagutils.create_shard(client, 'http://missing/tags/1/1.2/missing-1.2.0.0-final')
+        self.assertEqual(client.mkdirs, ['http://missing/tags/1/1.2'])
+
+    def test_update_tag_index(self):
+        client = MockPySvn('', '')
+        # No index yet
+        self.assertEqual(tagutils.read_tag_index(client, 'http://bar/tags'), {})
+        tagutils.index_tag(client, 'http://bar', 'http://bar/tags/1/1.2/bar-1.2.0.0-final')
+        self.assertEqual(client.files['http://bar/tags/{0}'.format(tagutils.TAG_INDEX_NAME)], 'bar-1.2.0.0-final\t1/1.2/bar-1.2.0.0-final\n')
+        self.assertEqual(len(client.added), 1)
+        # Existing index is extended and kept sorted
+        tagutils.index_tag(client, 'http://bar', 'http://bar/tags/1/1.1/bar-1.1.0.0-final')
+        self.assertEqual(tagutils.read_tag_index(client, 'http://bar/tags'),
+                         {'bar-1.1.0.0-final': '1/1.1/bar-1.1.0.0-final', 'bar-1.2.0.0-final': '1/1.2/bar-1.2.0.0-final'})
+        self.assertTrue(client.files['http://bar/tags/{0}'.format(tagutils.TAG_INDEX_NAME)].startswith('bar-1.1.0.0-final'))
+        self.assertEqual(len(client.added), 1)
+        # Already indexed (e.g. a replaced dev tag) doesn't commit
+        tagutils.index_tag(client, 'http://bar', 'http://bar/tags/1/1.1/bar-1.1.0.0-final')
+        self.assertEqual(client.checkins, 2)
+        # Previous tag is found through the index
+        os.environ[tagutils.TAG_LAYOUT] = tagutils.SHARDED_LAYOUT
+        self.assertEqual(tagutils.find_previous_tag(client, 'http://bar', 'bar', '1.3.0.0', 'final'), 'http://bar/tags/1/1.2/bar-1.2.0.0-final')
+        del os.environ[tagutils.TAG_LAYOUT]
+
+    def test_migrate_tags(self):
+        client = MockPySvn('', '')
+        client.listing = {'http://bar/tags': [('bar-1.0.0.0-final', 0),
+                                              ('bar-1.0.1.0-final', 0),
+                                              ('bar-1.1.0-dev', 0),
+                                              ('bar-2.0.0.0-rc1', 0),
+                                              ('1', 0),
+                                              (tagutils.TAG_INDEX_NAME, 0)]}
+        migration = tagutils.plan_migration(client, 'http://bar', 'bar')
+        self.assertEqual(migration, [('bar-1.0.0.0-final', '1/1.0'),
+                                     ('bar-1.0.1.0-final', '1/1.0'),
+                                     ('bar-1.1.0-dev', '1/1.1'),
+                                     ('bar-2.0.0.0-rc1', '2/2.0')])
+        tagutils.migrate_tags(client, 'http://bar', migration)
+        # Shards that exist aren't created
+        self.assertEqual(client.mkdirs, [])
+        self.assertEqual(client.moves, [(['http://bar/tags/bar-1.0.0.0-final', 'http://bar/tags/bar-1.0.1.0-final'], 'http://bar/tags/1/1.0'),
+                                        (['http://bar/tags/bar-1.1.0-dev'], 'http://bar/tags/1/1.1'),
+                                        (['http://bar/tags/bar-2.0.0.0-rc1'], 'http://bar/tags/2/2.0')])
+        # The index is updated after each shard's move
+        self.assertEqual(client.checkins, 3)
+        self.assertEqual(len(tagutils.read_tag_index(client, 'http://bar/tags')), 4)
+
+    def test_migrate_tags_interrupted(self):
+        client = MockPySvn('', '')
+        client.listing = {'http://bar/tags': [('1', 0), ('foo-1.0.0.0-final', 0), (tagutils.TAG_INDEX_NAME, 0)],
+                          'http://bar/tags/1': [('1.0', 0), ('1.1', 0)],
+                          'http://bar/tags/1/1.0': [('bar-1.0.0.0-final', 0), ('bar-1.0.1.0-final', 0)],
+                          'http://bar/tags/1/1.1': [('bar-1.1.0.0-final', 0), ('foo-1.1.0.0-final', 0)]}
+        client.files['http://bar/tags/{0}'.format(tagutils.TAG_INDEX_NAME)] = 'bar-1.0.0.0-final\t1/1.0/bar-1.0.0.0-final\n'
+        # A rerun finds the tags a failed migration moved but didn't index
+        self.assertEqual(tagutils.plan_migration(client, 'http://bar', 'bar'), [])
+        unindexed = tagutils.find_unindexed_tags(client, 'http://bar', 'bar')
+        self.assertEqual(unindexed, {'bar-1.0.1.0-final': '1/1.0/bar-1.0.1.0-final',
+                                     'bar-1.1.0.0-final': '1/1.1/bar-1.1.0.0-final'})
+        tagutils.migrate_tags(client, 'http://bar', [], unindexed)
+        self.assertEqual(client.moves, [])
+        self.assertEqual(len(tagutils.read_tag_index(client, 'http://bar/tags')), 3)
+        self.assertEqual(tagutils.find_unindexed_tags(client, 'http://bar', 'bar'), {})
+
     def test_validate_args(self):
         args = MockArgs('1.0.0.0', 'src', 'build', 'bin\\Debug', 'dev')
         self.assertTrue(tagutils.validate_args(args)[0])
         args = MockArgs('1.0.0', 'src', 'build', 'bin\\Debug', 'dev')
         self.assertFalse(tagutils.validate_args(args)[0])
+        # Additional artifacts
+        args = MockArgs('1.0.0.0', 'src', 'build', 'bin\\Debug', 'dev', ['pdb=symbols', 'setup=installers'])
+        self.assertTrue(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src', 'build', 'bin\\Debug', 'dev', ['pdb'])
+        self.assertFalse(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src', 'build', 'bin\\Debug', 'dev', ['pdb=/build/'])
+        self.assertFalse(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src', 'build', 'bin\\Debug', 'dev', ['pdb=symbols'], 'done')
+        self.assertFalse(tagutils.validate_args(args)[0])
+        # Selection of trunk subpaths
+        args = MockArgs('1.0.0.0', 'src:lib,include\\core', 'build', 'bin\\Debug', 'dev')
+        self.assertTrue(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src:lib,/lib/', 'build', 'bin\\Debug', 'dev')
+        self.assertFalse(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src:lib,lib/core', 'build', 'bin\\Debug', 'dev')
+        self.assertFalse(tagutils.validate_args(args)[0])
+        args = MockArgs('1.0.0.0', 'src:lib,', 'build', 'bin\\Debug', 'dev')
+        self.assertFalse(tagutils.validate_args(args)[0])
+
+    def test_percentile(self):
+        self.assertEqual(tagmetrics.percentile([], 50), None)
+        self.assertEqual(tagmetrics.percentile([3.0], 99), 3.0)
+        values = list(range(100, 0, -1))
+        self.assertEqual(tagmetrics.percentile(values, 50), 50)
+        self.assertEqual(tagmetrics.percentile(values, 95), 95)
+        self.assertEqual(tagmetrics.percentile(values, 99), 99)
+
+    def test_count_commits(self):
+        run = tagmetrics.start_run()
+        client = tagmetrics.count_commits(run, MockPySvn('/dummy/project/trunk', '/'))
+        client.mkdir(['http://svn/tags/a'], 'Create shard')
+        client.copy2([('http://svn/trunk', )], 'http://svn/tags/a/1.0.0.0')
+        client.info2('http://svn/tags/a/1.0.0.0')
+        self.assertEqual(client.commits, 2)
+        # Removing working copy paths is committed by the next checkin
+        client.remove(['/tmp/wc/a.dll'])
+        client.mkdir('/tmp/wc/lib', 'Create lib')
+        self.assertEqual(client.commits, 2)
+        client.remove('http://svn/tags/a/1.0.0.0')
+        self.assertEqual(client.commits, 3)
+        # Attributes are set on the wrapped client
+        client.callback_get_login = None
+        self.assertTrue(client.client.callback_get_login is None)
+
+    def test_record_run(self):
+        tempDir = tempfile.mkdtemp()
+        db = os.path.join(tempDir, 'metrics.sqlite')
+        try:
+            # Runs without a project aren't recorded
+            run = tagmetrics.start_run()
+            self.assertEqual(tagmetrics.record_run(run, 0, db), None)
+            self.assertFalse(os.path.exists(db))
+            for (project, exit_code) in [('a', 0), ('a', 1), ('b', 0)]:
+                run = tagmetrics.start_run()
+                tagmetrics.set_project(run, project, 'http://svn/{0}/trunk'.format(project), 'final')
+                tagmetrics.end_phase(run, 'create')
+                run['bytes'] = 10
+                self.assertEqual(tagmetrics.record_run(run, exit_code, db), None)
+            report = dict([((entry['group'], entry['name']), entry) for entry in tagmetrics.get_report(db)])
+            self.assertEqual(sorted(report.keys()), [('project', 'a'), ('project', 'b'), ('server', 'http://svn')])
+            self.assertEqual(report[('project', 'a')]['runs'], 2)
+            self.assertEqual(report[('project', 'a')]['failures'], 1)
+            self.assertEqual(report[('server', 'http://svn')]['bytes'], 30)
+            self.assertEqual(sorted(report[('server', 'http://svn')]['phases'].keys()), ['create'])
+            self.assertEqual(tagmetrics.get_report(db, time.time() + 60), [])
+            # Errors are returned, not raised
+            self.assertFalse(tagmetrics.record_run(run, 0, tempDir) is None)
+            # Text file export, with one label per metric family
+            path = os.path.join(tempDir, 'tagtrunk.prom')
+            tagmetrics.export_textfile(path, db)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue('# TYPE tagtrunk_project_runs_total counter' in lines)
+            self.assertTrue('tagtrunk_project_runs_total{project="a"} 2' in lines)
+            self.assertTrue('tagtrunk_server_failed_runs_total{server="http://svn"} 1' in lines)
+            self.assertTrue('tagtrunk_project_run_duration_seconds_count{project="b"} 1' in lines)
+            for line in lines:
+                if line.startswith('tagtrunk_project_'):
+                    self.assertTrue('{project="' in line)
+                elif line.startswith('tagtrunk_server_'):
+                    self.assertTrue('{server="' in line)
+                else:
+                    self.assertTrue(line.startswith('# HELP ') or line.startswith('# TYPE '))
+        finally:
+            shutil.rmtree(tempDir)
 
     def test_setup_svn_client(self):
         client = tagutils.setup_svn_client('', '')
@@ -350,6 +1088,7 @@ class TestTagUtils(unittest.TestCase):
 
     def test_tagtrunk(self):
         devnull = open(os.devnull, 'w')
+        os.environ[tagmetrics.METRICS_DB] = os.path.join(tempfile.mkdtemp(), 'metrics.sqlite')
         prog = 'tagtrunk.py'
         # Invalid command-line SYNTAX; must exit with error code 2
         sys.argv = []
@@ -440,31 +1179,52 @@ class MockPySvn():
         self.full_repo_project_path = '{0}{1}'.format(self.repos_root_URL, repo_project_path)
         self.project_path = project_path
         self.fail_qux = False
+        self.added = []
+        self.imported = []
+        self.listing = {}
+        self.summary = []
+        self.diffs = 0
+        self.logs = {}
+        self.log_fetches = []
+        self.mkdirs = []
+        self.moves = []
+        self.removed = []
+        self.files = {}
+        self.wc = None
+        self.checkins = 0
+        self.nothing_to_commit = False
 
     def info2(self, path, recurse=True):
         """Mock method of pysvn. Everytime info2 gets called, it will slice
         the last part of the path/URL. This emulates getting a matching URL/path
         pair everytime we visit the parent (which is what happens in get_repository_info.
         """
+        if 'missing' in path:
+            ce = pysvn.ClientError()
+            msg = 'Dummy exception for path not found'
+            ce.args = (msg, [(msg, svnerr.FS_NOT_FOUND)])
+            raise(ce)
         if 'foo' in path:
             ce = pysvn.ClientError()
             msg = 'Dummy exception for getting info'
             ce.args = (msg, [(msg, -1)])
             raise(ce)
         info = {'repos_root_URL': self.repos_root_URL,
-                'URL': self.full_repo_project_path}
+                'URL': self.full_repo_project_path,
+                'last_changed_rev': MockRevision()}
         (self.full_repo_project_path, _, _) = self.full_repo_project_path.rpartition('/')
         (self.project_path, _, _) = self.project_path.rpartition('/')
         return [(path, info)]
 
-    def mkdir(self, url, log_message):
+    def mkdir(self, url, log_message, make_parents=False):
+        self.mkdirs.append(url)
         if 'qux' in url:
             self.fail_qux = True
 
     def copy(self, from_url, to_url):
         self.copy2(from_url, to_url)
 
-    def copy2(self, sources, tag_source_url, make_parents=False):
+    def copy2(self, sources, tag_source_url, copy_as_child=False, make_parents=False):
         if 'bar' in tag_source_url or self.fail_qux:
             self.fail_qux = False
             ce = pysvn.ClientError()
@@ -478,9 +1238,96 @@ class MockPySvn():
             raise(ce)
 
     def import_(self, path, url, log_message):
+        # Record the files that would have been imported
+        files = []
+        for (dirpath, _, filenames) in os.walk(path):
+            files.extend([os.path.relpath(os.path.join(dirpath, f), path) for f in filenames])
+        self.imported.append((path, url, files))
+        return MockRevision()
+
+    def list(self, url, recurse=True, dirent_fields=0):
+        if url not in self.listing:
+            ce = pysvn.ClientError()
+            msg = 'Dummy exception for path not found'
+            ce.args = (msg, [(msg, svnerr.FS_NOT_FOUND)])
+            raise(ce)
+        entries = [({'path': url, 'kind': pysvn.node_kind.dir, 'size': 0}, None)]
+        for (relpath, size) in self.listing[url]:
+            path = '{0}/{1}'.format(url, relpath) if relpath else url
+            entries.append(({'path': path, 'kind': pysvn.node_kind.file, 'size': size}, None))
+        return entries
+
+    def diff_summarize(self, url1, revision1, url2, revision2, recurse=True):
+        self.diffs += 1
+        return [{'path': path, 'summarize_kind': kind, 'prop_changed': prop_changed}
+                for (path, kind, prop_changed) in self.summary]
+
+    def root_url_from_path(self, url):
+        return '/'.join(url.split('/')[:3])
+
+    def log(self, url, revision_start=None, revision_end=None, discover_changed_paths=False, strict_node_history=True, peg_revision=None):
+        # Entries are (revision, message, [(copyfrom_path, copyfrom_revision[, path])])
+        entries = self.logs.get(url, [])
+        if revision_end is not None:
+            self.log_fetches.append((revision_start.number, revision_end.number))
+            entries = sorted([entry for entry in entries if revision_start.number <= entry[0] <= revision_end.number])
+        result = []
+        for (revision, message, copies) in entries:
+            revision_obj = MockRevision()
+            revision_obj.number = revision
+            changed_paths = []
+            for copy in copies:
+                copyfrom = MockRevision()
+                copyfrom.number = copy[1]
+                changed_paths.append({'path': copy[2] if len(copy) > 2 else '',
+                                      'copyfrom_path': copy[0],
+                                      'copyfrom_revision': copyfrom})
+            result.append({'revision': revision_obj,
+                           'author': 'teamcity',
+                           'date': 0.0,
+                           'message': message,
+                           'changed_paths': changed_paths})
+        return result
+
+    def checkout(self, url, path, depth=None):
+        self.wc = (url, path)
+
+    def update(self, path):
+        (url, wc) = self.wc
+        url = '{0}/{1}'.format(url, os.path.relpath(path, wc).replace(os.sep, '/'))
+        if url in self.files:
+            f = open(path, 'w')
+            f.write(self.files[url])
+            f.close()
+
+    def cat(self, url):
+        if url not in self.files:
+            ce = pysvn.ClientError()
+            msg = 'Dummy exception for path not found'
+            ce.args = (msg, [(msg, svnerr.FS_NOT_FOUND)])
+            raise(ce)
+        return self.files[url]
+
+    def move2(self, sources, url, move_as_child=False):
+        self.moves.append(([source for (source,) in sources], url))
+
+    def add(self, path, add_parents=False):
+        self.added.append(path)
+
+    def checkin(self, paths, log_message):
+        self.checkins += 1
+        (url, wc) = self.wc
+        for path in paths:
+            if os.path.isfile(path):
+                f = open(path)
+                self.files['{0}/{1}'.format(url, os.path.relpath(path, wc).replace(os.sep, '/'))] = f.read()
+                f.close()
+        if self.nothing_to_commit:
+            return None
         return MockRevision()
 
     def remove(self, url):
+        self.removed.append(url)
         if 'bar' in url:
             ce = pysvn.ClientError()
             msg = 'Dummy exception for path exists'
@@ -495,12 +1342,23 @@ class MockPySvn():
 class MockArgs():
     """Class that mocks Python's argument parser."""
 
-    def __init__(self, V, S, B, BS, T):
+    def __init__(self, V, S, B, BS, T, artifacts=None, watch=None):
         self.V = V
         self.S = S
         self.B = B
         self.BS = BS
         self.T = T
+        self.artifacts = artifacts
+        self.watch = watch
+
+class MockCompareArgs():
+    """Class that mocks Python's argument parser for comparing tags."""
+
+    def __init__(self, FROM, TO, S, B='build'):
+        self.FROM = FROM
+        self.TO = TO
+        self.S = S
+        self.B = B
 
 if __name__ == '__main__':
     # Produces more verbose output than unittest.main()